@@ -1,21 +1,44 @@
 #!/usr/bin/env python
 """Find notable content in the journal and email it.
 
-Tested with Python 3.4
+Needs Python 3.7 or newer (python-systemd too, unless only exported journals
+are read with --input).
 
 Inspired by: https://tim.siosm.fr/blog/2014/02/24/journald-log-scanner-python/
 
 """
 __author__ = 'Rich Li'
-__version__ = 0.3
+__version__ = 1.3
 
 # Version history:
 # v0.1 2014-06-14: Started
 # v0.2 2014-07-01: Updated to group output from various services
 # v0.3 2015-03-06: Switch to attic instead of obnam, group mail-related logs
+# v0.4 2026-10-18: Load the filter rules from the config, compile them once
+# v0.5 2026-10-18: Optionally push the filtering down into sd-journal matches
+# v0.6 2026-10-18: Resume from the cursor saved by the previous run
+# v0.7 2026-10-18: Add --follow, which emails batched digests as entries arrive
+# v0.8 2026-10-18: Collapse repeated messages, cap the size of each section
+# v0.9 2026-10-18: Keep compact records, only format them for the email
+# v1.0 2026-10-18: Scan journal files in parallel with --jobs
+# v1.1 2026-10-18: Count logins, write per-run metrics to a JSON lines/CSV file
+# v1.2 2026-10-18: Make python-systemd optional so journalwatch_bench.py runs anywhere
+# v1.3 2026-10-18: Read journal export/JSON files or stdin with --input
 
 import argparse
+from collections import namedtuple
+from collections import Counter as Tally
+from concurrent.futures import ProcessPoolExecutor
+import csv
 from datetime import datetime, timedelta
+import functools
+import heapq
+import os
+import signal
+import sys
+import syslog
+import tempfile
+import time
 import re
 import json
 from email import charset
@@ -24,7 +47,1094 @@ import email.utils
 import ssl
 from smtplib import SMTP
 
-from systemd import journal
+try:
+    from systemd import journal
+except ImportError:
+    # Only needed to read the journal, not for the filtering itself
+    journal = None
+
+
+#################
+# Default filter rules
+#################
+# Any of "rules", "counters" and "groups" that's missing from the config file
+# is taken from here.
+#
+# Rules are tried in order and the first one that matches an entry decides
+# what happens to it: "ignore" drops it, "group" files it under one of the
+# per-service sections of the email. Entries that no rule matches are
+# reported as-is. A rule matches on either the systemd unit ("units" for exact
+# names, "unit_pattern" for dynamically named units) or, for entries without a
+# unit, the syslog identifier ("identifiers", "identifier_pattern"). An
+# optional "message" regex restricts the rule to matching messages only.
+#
+# Counters are checked against the entries filed under their group. If the
+# regex has a group, the last captured value is kept, otherwise the matches
+# are counted. A rule may have a "name" for the metrics, otherwise it's named
+# after its group (or "ignore-<index>").
+DEFAULT_CONFIG = {
+    'rules': [
+        {'action': 'ignore',
+         'units': ['udisks.service',
+                   'polkit.service',
+                   'avahi-daemon.service',
+                   'bluetooth.service',
+                   'accounts-daemon.service',
+                   'rtkit-daemon.service',
+                   'dbus.service',
+                   'lightdm.service',
+                   'systemd-udevd.service',
+                   'envoy@ssh-agent.service',
+                   'mkinitcpio-generate-shutdown-ramfs.service']},
+        {'action': 'ignore', 'unit_pattern': r'user@\d+\.service'},
+        {'action': 'ignore', 'unit_pattern': r'.*btsync',
+         'message': r'UPnP: Device error'},
+        {'action': 'ignore', 'units': ['systemd-journald.service'],
+         'message': r'Journal (started|stopped)'},
+        {'action': 'ignore', 'units': ['systemd-logind.service'],
+         'message': r'Watching system buttons '},
+        {'action': 'ignore', 'unit_pattern': r'session-[a-z]?\d+\.scope'},
+        # {'action': 'ignore', 'unit_pattern': r'sshd@',
+        #  'message': r'Accepted publickey for (earl|git)'},
+        # {'action': 'ignore', 'units': ['postfix.service'],
+        #  'message': r'warning: hostname .* does not resolve to address'},
+        {'action': 'group', 'group': 'attic', 'unit_pattern': r'.*attic'},
+        {'action': 'group', 'group': 'pacupdate',
+         'units': ['pacupdate.service']},
+        {'action': 'group', 'group': 'timesyncd',
+         'units': ['systemd-timesyncd.service']},
+        {'action': 'group', 'group': 'sshd',
+         'unit_pattern': r'sshd@[0-9a-f.:]*'},
+        {'action': 'group', 'group': 'mail',
+         'units': ['dovecot.service',
+                   'postfix.service',
+                   'opendkim.service',
+                   'spamassassin.service']},
+        {'action': 'ignore',
+         'identifiers': ['systemd',
+                         'kernel',
+                         'bluetoothd',
+                         'systemd-sysctl',
+                         'systemd-journald',
+                         'systemd-udevd',
+                         'ntpd', 'mtp-probe']},
+        # {'action': 'ignore', 'identifiers': ['postfix/anvil'],
+        #  'message': r'statistics:'},
+    ],
+    'counters': [
+        {'name': 'attic_backups', 'group': 'attic',
+         'message': r'Archive fingerprint: ',
+         'summary': 'attic backed up {} times'},
+        {'name': 'attic_fingerprint', 'group': 'attic',
+         'message': r'Archive fingerprint: (\S+)',
+         'summary': 'last attic archive fingerprint: {}'},
+        {'name': 'pacupdate_packages', 'group': 'pacupdate',
+         'message': r'Packages \((\d+)\)',
+         'summary': 'pacupdate found {} packages to update'},
+        {'name': 'ssh_logins', 'group': 'sshd',
+         'message': r'Accepted \S+ for ',
+         'summary': 'ssh: {} successful logins'},
+        {'name': 'ssh_login_failures', 'group': 'sshd',
+         'message': r'(?:Failed \S+ for|Invalid user) ',
+         'summary': 'ssh: {} failed logins'},
+        {'name': 'dovecot_logins', 'group': 'mail',
+         'message': r'\w+-login: Login: ',
+         'summary': 'dovecot: {} successful logins'},
+        {'name': 'dovecot_login_failures', 'group': 'mail',
+         'message': r'\w+-login: .*auth failed',
+         'summary': 'dovecot: {} failed logins'},
+        {'name': 'postfix_logins', 'group': 'mail',
+         'message': r'.*sasl_username=',
+         'summary': 'postfix: {} successful SASL logins'},
+        {'name': 'postfix_login_failures', 'group': 'mail',
+         'message': r'warning: .*: SASL \S+ authentication failed',
+         'summary': 'postfix: {} failed SASL logins'},
+    ],
+    'groups': ['attic', 'pacupdate', 'sshd', 'mail', 'timesyncd'],
+    # At most this many distinct messages are kept per section of the email
+    'max_templates': 100,
+}
+
+Rule = namedtuple('Rule', 'index name action group message counters')
+Counter = namedtuple('Counter', 'name message summary capture')
+
+# Upper bound on the number of memoized unit names per field. Dynamically
+# named units (sshd@..., session-N.scope) are mostly unique, so the cache is
+# simply dropped when it fills up.
+_LOOKUP_CACHE_SIZE = 4096
+
+
+class _FieldIndex:
+    """Maps the values of one entry field to the rules that may apply.
+
+    Exact values are a dict lookup. The patterns for dynamically named values
+    are joined into one alternation regex, so a single match finds the first
+    pattern rule that applies. Resolved values are memoized.
+
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.patterns = []
+        self._combined = None
+        self._cache = {}
+
+    def add(self, rule, values=(), pattern=None):
+        for value in values:
+            self.exact.setdefault(value, []).append(rule)
+        if pattern is not None:
+            self.patterns.append((rule, re.compile(pattern)))
+
+    def compile(self):
+        if self.patterns:
+            self._combined = re.compile('|'.join(
+                '(?P<r{}>{})'.format(rule.index, regex.pattern)
+                for rule, regex in self.patterns))
+
+    def lookup(self, value):
+        """Return the rules to try for this value, in order.
+
+        The chain ends at the first rule that has no message regex, since
+        nothing after it can ever be reached.
+
+        """
+        try:
+            return self._cache[value]
+        except KeyError:
+            pass
+
+        candidates = list(self.exact.get(value, ()))
+        if self._combined is not None:
+            match = self._combined.match(value)
+            if match:
+                # The alternation picks the first pattern rule that matches.
+                # Only if that one depends on the message do the later
+                # patterns need to be tried as well.
+                first = int(match.lastgroup[1:])
+                for rule, regex in self.patterns:
+                    if rule.index == first:
+                        candidates.append(rule)
+                        if rule.message is None:
+                            break
+                    elif rule.index > first and regex.match(value):
+                        candidates.append(rule)
+        candidates.sort(key=lambda rule: rule.index)
+
+        chain = []
+        for rule in candidates:
+            chain.append(rule)
+            if rule.message is None:
+                break
+        chain = tuple(chain)
+
+        if len(self._cache) >= _LOOKUP_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[value] = chain
+        return chain
+
+
+class FilterEngine:
+    """Classifies journal entries according to the compiled rules.
+
+    Per entry this is one dict lookup on the unit (or syslog identifier) for
+    the common cases, plus whatever message regexes the matching rules have.
+
+    """
+
+    def __init__(self, rules, counters):
+        counter_map = {}
+        for spec in counters:
+            regex = re.compile(spec['message'])
+            counter_map.setdefault(spec['group'], []).append(Counter(
+                spec['name'], regex, spec.get('summary', spec['name'] + ': {}'),
+                regex.groups > 0))
+        self.counters = [counter for group in counter_map.values()
+                         for counter in group]
+
+        self.rules = []
+        self._units = _FieldIndex()
+        self._identifiers = _FieldIndex()
+        for index, spec in enumerate(rules):
+            if spec['action'] not in ('ignore', 'group'):
+                raise ValueError('Unknown rule action: {}'.format(spec['action']))
+            group = spec.get('group')
+            message = spec.get('message')
+            name = spec.get('name', group or 'ignore-{}'.format(index))
+            rule = Rule(index, name, spec['action'], group,
+                        re.compile(message) if message is not None else None,
+                        tuple(counter_map.get(group, ())))
+            self.rules.append(rule)
+            self._units.add(rule, spec.get('units', ()),
+                            spec.get('unit_pattern'))
+            self._identifiers.add(rule, spec.get('identifiers', ()),
+                                  spec.get('identifier_pattern'))
+        self._units.compile()
+        self._identifiers.compile()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('rules', DEFAULT_CONFIG['rules']),
+                   config.get('counters', DEFAULT_CONFIG['counters']))
+
+    def unit_rules(self, unit):
+        """Return the rules that may apply to entries of this unit."""
+        return self._units.lookup(unit)
+
+    def identifier_rules(self, identifier):
+        """Return the rules that may apply to entries without a unit."""
+        return self._identifiers.lookup(identifier)
+
+    def classify(self, entry):
+        """Return the first rule matching this entry, or None."""
+        message = entry.get('MESSAGE')
+        if message is None:
+            return None
+
+        unit = entry.get('_SYSTEMD_UNIT')
+        if unit is not None:
+            chain = self._units.lookup(unit)
+        else:
+            chain = self._identifiers.lookup(entry.get('SYSLOG_IDENTIFIER', ''))
+
+        for rule in chain:
+            if rule.message is None or rule.message.match(message):
+                return rule
+        return None
+
+
+def always_ignored(chain):
+    """Whether a rule chain drops every entry, whatever its message."""
+    return bool(chain) and chain[0].action == 'ignore' and chain[0].message is None
+
+
+# The pass of scan_matched() reading the units that are always ignored
+_IGNORED = object()
+
+# How the entries without a unit get into the journal: the kernel log, the
+# audit subsystem and journald's own messages. Everything logged by a process
+# (syslog, the native protocol, stdout) comes from some unit.
+UNITLESS_TRANSPORTS = ('kernel', 'audit', 'driver')
+
+
+def unit_pass(engine, unit):
+    """Return the pass of scan_matched() that reads this unit's entries.
+
+    That's the group of units filed under one, None for the pass shared by
+    the other kept units, or _IGNORED.
+
+    """
+    chain = engine.unit_rules(unit)
+    if always_ignored(chain):
+        return _IGNORED
+    if chain and all(rule.action == 'group' for rule in chain):
+        return chain[-1].group
+    return None
+
+
+def template_slice(unit):
+    """Return the slice systemd puts a template instance in, or None.
+
+    Instances of foo@.service run in system-foo.slice, unless the unit file
+    sets Slice=.
+
+    """
+    template, at, _ = unit.partition('@')
+    if not at or not template:
+        return None
+    return 'system-{}.slice'.format(template.replace('-', '\\x2d'))
+
+
+# Where a scan starts (a cursor, or a time when there's no usable cursor) and
+# the last entry it covers
+Window = namedtuple('Window', 'since cursor until until_cursor')
+
+
+def load_state(path):
+    """Return the state saved by the previous run, or None.
+
+    A corrupt state file is reported and treated as missing, so the run
+    falls back to the time window.
+
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        datetime.fromisoformat(state['realtime'])
+        state['cursor']
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        print('Ignoring the corrupt state file {} ({!r})'.format(path, e),
+              file=sys.stderr)
+        return None
+    return state
+
+
+def save_state(path, cursor, realtime):
+    """Atomically replace the state file with the given cursor."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.journalwatch-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'cursor': cursor, 'realtime': realtime.isoformat()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def scan_window(state, default_since, files=None):
+    """Work out which entries this run covers.
+
+    The scan resumes right after the saved cursor. If the cursor is gone
+    (e.g. the journal file holding it was rotated away), it falls back to the
+    time of the saved entry, or to default_since without any saved state. It
+    stops at the last entry present now, so that entries written during the
+    scan are left for the next run.
+
+    files restricts the scan to those journal files, rather than the local
+    journal.
+
+    """
+    j = journal.Reader(files=files)
+    j.seek_tail()
+    last = j.get_previous()
+    until = last.get('__REALTIME_TIMESTAMP')
+    until_cursor = last.get('__CURSOR')
+
+    since = default_since
+    cursor = None
+    if state:
+        since = datetime.fromisoformat(state['realtime'])
+        try:
+            j.seek_cursor(state['cursor'])
+            j.get_next()
+            if j.test_cursor(state['cursor']):
+                cursor = state['cursor']
+        except (OSError, ValueError):
+            pass
+        if cursor is None:
+            print('Saved cursor not found in the journal, scanning from {}'
+                  .format(since), file=sys.stderr)
+    j.close()
+    return Window(since, cursor, until, until_cursor)
+
+
+def open_reader(window, matches=(), files=None, require=(), read=None):
+    """Yield the entries in the window, restricted to the given matches.
+
+    Any of the matches will do, and they're AND'ed with the PRIORITY matches
+    added by log_level and with require (where each field must match one of
+    its values). sd-journal only ORs matches on the same field by itself
+    (different fields are AND'ed), so the fields of matches are put in
+    separate disjunctions.
+
+    read, a Tally, counts the entries sd-journal returned under 'entries',
+    including those the caller drops afterwards.
+
+    """
+    if window.until is None:
+        # The journal is empty
+        return
+    j = journal.Reader(files=files)
+    j.log_level(journal.LOG_INFO)
+    if require:
+        j.add_conjunction()
+        for match in require:
+            j.add_match(match)
+    fields = {}
+    for match in matches:
+        fields.setdefault(match.split('=', 1)[0], []).append(match)
+    if fields:
+        j.add_conjunction()
+    for index, field_matches in enumerate(fields.values()):
+        if index:
+            j.add_disjunction()
+        for match in field_matches:
+            j.add_match(match)
+    if window.cursor is not None:
+        j.seek_cursor(window.cursor)
+    else:
+        j.seek_realtime(window.since)
+
+    for entry in j:
+        if read is not None:
+            read['entries'] += 1
+        if entry['__REALTIME_TIMESTAMP'] > window.until:
+            break
+        # After seek_cursor() the first entry is the one already processed
+        if entry['__CURSOR'] == window.cursor:
+            continue
+        yield entry
+        if entry['__CURSOR'] == window.until_cursor:
+            break
+    j.close()
+
+
+def scan_full(window, files=None, read=None):
+    """Yield every entry in the window, leaving all filtering to the engine."""
+    return open_reader(window, files=files, read=read)
+
+
+def match_passes(engine, files=None):
+    """Turn the rules into sd-journal match sets, one per pass.
+
+    The distinct units and identifiers in the journal are enumerated from its
+    field indexes and run through the engine once each. Those that are always
+    ignored get no match at all, so their entries are never read. Units filed
+    under a group get one pass per group, everything else that's left shares
+    one pass. Returns the unit passes as {pass: matches} (see unit_pass) and
+    the identifier matches.
+
+    Template instances (sshd@<n>-<addr>.service, one per connection) are
+    matched on their slice instead of one term each: sd-journal walks every
+    term of a pass on each step, and a host under ssh brute force has
+    thousands of them. The slice also returns units of other passes, which
+    scan_matched() skips.
+
+    Entries without a MESSAGE are only seen if their unit is matched.
+
+    """
+    j = journal.Reader(files=files)
+    slices = set(j.query_unique('_SYSTEMD_SLICE'))
+    passes = {}
+    for unit in j.query_unique('_SYSTEMD_UNIT'):
+        label = unit_pass(engine, unit)
+        if label is _IGNORED:
+            continue
+        slice_name = template_slice(unit)
+        if slice_name in slices:
+            match = '_SYSTEMD_SLICE=' + slice_name
+        else:
+            match = '_SYSTEMD_UNIT=' + unit
+        # A dict rather than a set keeps the matches in a stable order
+        passes.setdefault(label, {})[match] = None
+
+    # Entries without a unit can't be matched directly (there are no negative
+    # matches), so this pass is narrowed down to the transports they come
+    # from (see scan_matched()). Any that do have a unit are skipped there.
+    identifiers = ['SYSLOG_IDENTIFIER=' + identifier
+                   for identifier in j.query_unique('SYSLOG_IDENTIFIER')
+                   if not always_ignored(engine.identifier_rules(identifier))]
+    j.close()
+    return {label: list(matches) for label, matches in passes.items()}, identifiers
+
+
+def _pass_entries(entries, label, engine, labels):
+    """Skip the entries a slice match brought in that belong to other passes.
+
+    labels memoizes unit_pass() across the passes.
+
+    """
+    for entry in entries:
+        unit = entry.get('_SYSTEMD_UNIT')
+        if unit is None:
+            continue
+        try:
+            entry_label = labels[unit]
+        except KeyError:
+            entry_label = labels[unit] = unit_pass(engine, unit)
+        if entry_label == label:
+            yield entry
+
+
+def scan_matched(engine, window, files=None, read=None):
+    """Yield the entries in the window that the rules may keep, in time order.
+
+    Each pass is a separate reader with its own matches, and the passes are
+    merged on their timestamps. The pass for entries without a unit only
+    reads the UNITLESS_TRANSPORTS, so the entries of ignored units logging
+    under a kept identifier (dbus-daemon, sshd, ...) aren't read at all.
+
+    read counts the entries sd-journal returned (see open_reader).
+
+    """
+    unit_passes, identifiers = match_passes(engine, files)
+    labels = {}
+    readers = [_pass_entries(open_reader(window, matches, files, read=read),
+                             label, engine, labels)
+               for label, matches in unit_passes.items()]
+    if identifiers:
+        transports = ['_TRANSPORT=' + transport
+                      for transport in UNITLESS_TRANSPORTS]
+        readers.append(entry for entry in open_reader(
+                           window, identifiers, files, transports, read)
+                       if '_SYSTEMD_UNIT' not in entry)
+    return heapq.merge(*readers,
+                       key=lambda entry: entry['__REALTIME_TIMESTAMP'])
+
+
+def journal_files(directories):
+    """Return all the journal files under the given directories."""
+    files = []
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            files.extend(os.path.join(root, name) for name in names
+                         if name.endswith(('.journal', '.journal~')))
+    return sorted(files)
+
+
+def split_files(files):
+    """Group journal files into independent units of work.
+
+    A journal directory holds one subdirectory per machine ID, and within it
+    (or within a remote/ directory) each stream, e.g. system, user-1000 or
+    remote-<host>, has an active file plus its rotated system@....journal
+    files. Each stream of each directory becomes one group.
+
+    """
+    streams = {}
+    for path in files:
+        stream = os.path.basename(path).split('@', 1)[0]
+        stream = stream.rsplit('.journal', 1)[0]
+        streams.setdefault((os.path.dirname(path), stream), []).append(path)
+    return list(streams.values())
+
+
+def _scan_files(config, window, files, match):
+    """Scan some journal files into a digest (run in a worker process)."""
+    engine = FilterEngine.from_config(config)
+    digest = Digest.from_config(config)
+    if match:
+        entries = scan_matched(engine, window, files)
+    else:
+        entries = scan_full(window, files)
+    for entry in entries:
+        digest.add(engine.classify(entry), entry)
+    return digest
+
+
+def scan_parallel(config, window, files, jobs, match=False):
+    """Scan the journal files in a process pool and merge the digests.
+
+    Each worker compiles its own filter engine and returns a capped Digest,
+    so only compact partial results cross the process boundary.
+
+    """
+    digest = Digest.from_config(config)
+    with ProcessPoolExecutor(jobs or None) as pool:
+        futures = [pool.submit(_scan_files, config, window, group, match)
+                   for group in split_files(files)]
+        for future in futures:
+            digest.merge(future.result())
+    return digest
+
+
+#################
+# Exported journals
+#################
+# The fields the filter engine and the digest look at. The export parser
+# skips (and never decodes) all the others.
+ENTRY_FIELDS = ('__REALTIME_TIMESTAMP', '__CURSOR', 'PRIORITY', 'MESSAGE',
+                'SYSLOG_IDENTIFIER', '_SYSTEMD_UNIT', '_PID')
+_ENTRY_FIELDS = frozenset(field.encode() for field in ENTRY_FIELDS)
+
+
+def convert_fields(fields):
+    """Give the fields of an exported entry the types python-systemd uses."""
+    entry = fields
+    entry['__REALTIME_TIMESTAMP'] = datetime.fromtimestamp(
+        int(fields['__REALTIME_TIMESTAMP']) / 1e6)
+    for name in ('PRIORITY', '_PID'):
+        if name in fields:
+            entry[name] = int(fields[name])
+    return entry
+
+
+def read_export(f, chunk_size=1 << 20):
+    """Yield the entries of a journal in the export format (journalctl -o export).
+
+    The file is read in chunk_size blocks and parsed incrementally. Text
+    fields are NAME=value lines. Binary-safe fields are a NAME line followed
+    by a little-endian 64 bit size, the data and a newline. Entries end with
+    an empty line. Only the first value of a repeated field is kept.
+
+    """
+    buf = bytearray()
+    fields = {}
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        pos = 0
+        while True:
+            newline = buf.find(b'\n', pos)
+            if newline < 0:
+                break
+            if newline == pos:
+                if fields:
+                    yield convert_fields(fields)
+                    fields = {}
+                pos += 1
+                continue
+
+            equals = buf.find(b'=', pos, newline)
+            if equals >= 0:
+                name = bytes(buf[pos:equals])
+                value_start, value_end = equals + 1, newline
+                next_pos = newline + 1
+            else:
+                if len(buf) < newline + 9:
+                    break
+                name = bytes(buf[pos:newline])
+                size = int.from_bytes(buf[newline + 1:newline + 9], 'little')
+                value_start = newline + 9
+                value_end = value_start + size
+                if len(buf) <= value_end:
+                    break
+                next_pos = value_end + 1
+
+            if name in _ENTRY_FIELDS:
+                name = name.decode()
+                if name not in fields:
+                    fields[name] = buf[value_start:value_end].decode(
+                        'utf-8', 'replace')
+            pos = next_pos
+        del buf[:pos]
+
+        if not chunk:
+            break
+    if fields:
+        yield convert_fields(fields)
+
+
+def read_json(f):
+    """Yield the entries of a journal in the JSON format (journalctl -o json).
+
+    Binary fields are lists of byte values and repeated fields lists of
+    values, only their first value is kept. Fields too big to show (over 4096
+    bytes, without journalctl --all) are null, and taken as missing.
+
+    """
+    for line in f:
+        fields = {}
+        for name, value in json.loads(line).items():
+            if name not in ENTRY_FIELDS:
+                continue
+            if isinstance(value, list) and not (value and isinstance(value[0], int)):
+                # A repeated field
+                value = value[0] if value else None
+            if isinstance(value, list):
+                value = bytes(value).decode('utf-8', 'replace')
+            if value is None:
+                continue
+            fields[name] = value
+        yield convert_fields(fields)
+
+
+def read_files(paths, file_format='export'):
+    """Yield the entries at LOG_INFO or above from exported journal files.
+
+    A path of "-" is stdin.
+
+    """
+    for path in paths:
+        if path == '-':
+            f = sys.stdin.buffer
+        else:
+            f = open(path, 'rb', buffering=1 << 20)
+        with f:
+            reader = read_export(f) if file_format == 'export' else read_json(f)
+            for entry in reader:
+                if entry.get('PRIORITY', syslog.LOG_INFO) <= syslog.LOG_INFO:
+                    yield entry
+
+
+def benchmark(engine, config, window):
+    """Compare the full scan with the matched scan over the same window."""
+    results = []
+    for name, scan in (('full scan', scan_full),
+                       ('matched scan', functools.partial(scan_matched, engine))):
+        digest = Digest.from_config(config)
+        read = Tally()
+        kept = 0
+        start = time.perf_counter()
+        for entry in scan(window, read=read):
+            kept += 1
+            digest.add(engine.classify(entry), entry)
+        elapsed = time.perf_counter() - start
+        results.append(digest.render(engine, window.since))
+        # What sd-journal had to deserialize is what costs, whatever is
+        # dropped afterwards
+        print('{}: {} entries read ({} kept) in {:0.2f} s ({:0.0f} entries/s)'
+              .format(name, read['entries'], kept, elapsed,
+                      read['entries'] / elapsed if elapsed else 0))
+    if results[0] != results[1]:
+        print('WARNING: the two scans produced different digests')
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_second(second):
+    return second.strftime("%a %b %d %I:%M:%S %p")
+
+
+def format_timestamp(realtime):
+    """Format a timestamp for the email, cached per second."""
+    return _format_second(realtime.replace(microsecond=0))
+
+
+class Record:
+    """The fields of a journal entry that make it into the email."""
+
+    __slots__ = ('realtime', 'priority', 'unit', 'identifier', 'pid', 'message')
+
+    def __init__(self, realtime, priority, unit, identifier, pid, message):
+        self.realtime = realtime
+        self.priority = priority
+        self.unit = unit
+        self.identifier = identifier
+        self.pid = pid
+        self.message = message
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(entry['__REALTIME_TIMESTAMP'], entry.get('PRIORITY'),
+                   entry.get('_SYSTEMD_UNIT'), entry.get('SYSLOG_IDENTIFIER'),
+                   entry.get('_PID'), entry.get('MESSAGE'))
+
+    def render(self):
+        """Format the record as a line of the email."""
+        if self.message is None:
+            return '{} {}[{}]: empty'.format(
+                format_timestamp(self.realtime), self.priority, self.identifier)
+        if self.unit is not None:
+            return 'U %s %s %s %s[%s]: %s' % (
+                format_timestamp(self.realtime), self.priority, self.unit,
+                self.identifier or 'UNKNOWN', self.pid, self.message)
+        return 'S %s %s %s: %s' % (
+            format_timestamp(self.realtime), self.priority,
+            self.identifier or 'UNKNOWN', self.message)
+
+
+# Variable parts of a message, replaced to get its template
+_IP_ADDRESS = re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}\b|'
+                         r'\b(?:[0-9a-f]{0,4}:){2,7}[0-9a-f]{0,4}\b', re.I)
+_HEX_ID = re.compile(r'\b(?=[0-9a-f]*\d)[0-9a-f]{8,}\b', re.I)
+_NUMBER = re.compile(r'\d+')
+
+
+def message_template(message):
+    """Normalize the addresses, IDs and numbers out of a message."""
+    message = _IP_ADDRESS.sub('<ip>', message)
+    message = _HEX_ID.sub('<hex>', message)
+    return _NUMBER.sub('#', message)
+
+
+class _Section:
+    """The entries of one section of the digest, collapsed by template.
+
+    Each distinct template keeps its first entry as an exemplar Record, plus a
+    count and the time of the last repeat. Once the section holds limit
+    templates, entries with new templates are only counted. Nothing is
+    formatted until the section is rendered.
+
+    """
+
+    __slots__ = ('templates', 'limit', 'dropped')
+
+    def __init__(self, limit):
+        self.templates = {}
+        self.limit = limit
+        self.dropped = 0
+
+    def __bool__(self):
+        return bool(self.templates or self.dropped)
+
+    def add(self, entry):
+        key = (entry.get('SYSLOG_IDENTIFIER'), entry.get('PRIORITY'),
+               message_template(entry['MESSAGE']) if 'MESSAGE' in entry else None)
+        seen = self.templates.get(key)
+        if seen is not None:
+            seen[0] += 1
+            seen[2] = entry['__REALTIME_TIMESTAMP']
+        elif len(self.templates) < self.limit:
+            record = Record.from_entry(entry)
+            self.templates[key] = [1, record.realtime, record.realtime, record]
+        else:
+            self.dropped += 1
+
+    def merge(self, other):
+        """Add the templates of another section, e.g. from a worker."""
+        for key, (count, first, last, record) in other.templates.items():
+            seen = self.templates.get(key)
+            if seen is not None:
+                seen[0] += count
+                if first < seen[1]:
+                    seen[1], seen[3] = first, record
+                seen[2] = max(seen[2], last)
+            elif len(self.templates) < self.limit:
+                self.templates[key] = [count, first, last, record]
+            else:
+                self.dropped += count
+        self.dropped += other.dropped
+        # Keep the exemplars in time order
+        self.templates = dict(sorted(self.templates.items(),
+                                     key=lambda item: item[1][1]))
+
+    def render(self):
+        lines = []
+        for count, first, last, record in self.templates.values():
+            lines.append(record.render())
+            if count > 1:
+                lines.append('    (repeated {} times, first {}, last {})'.format(
+                    count, first.strftime('%a %H:%M:%S'),
+                    last.strftime('%a %H:%M:%S')))
+        if self.dropped:
+            lines.append('    ({} more entries with other messages not shown)'
+                         .format(self.dropped))
+        return lines
+
+
+@functools.lru_cache(maxsize=4096)
+def unit_key(unit):
+    """Name a unit for the metrics, without its per-instance parts."""
+    return message_template(unit)
+
+
+class Digest:
+    """Collects the notable entries of a scan and renders the email body.
+
+    Repeated messages are collapsed and the number of distinct messages per
+    section is capped, so memory use stays flat however much gets logged.
+
+    Every entry, ignored or not, is also tallied per unit (or identifier),
+    per priority and per rule for the metrics.
+
+    """
+
+    def __init__(self, groups, max_templates=DEFAULT_CONFIG['max_templates']):
+        self.groups = list(groups)
+        self.max_templates = max_templates
+        self.sections = {group: _Section(max_templates) for group in self.groups}
+        self.remaining = _Section(max_templates)
+        self.counters = {}
+        self.captured = {}  # counter name -> time of its captured value
+        self.units = Tally()
+        self.priorities = Tally()
+        self.rules = Tally()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('groups', DEFAULT_CONFIG['groups']),
+                   config.get('max_templates', DEFAULT_CONFIG['max_templates']))
+
+    def add(self, rule, entry):
+        """File an entry according to the rule it matched (or None)."""
+        unit = entry.get('_SYSTEMD_UNIT')
+        # Keys must be strings for the metrics (sorted, in JSON)
+        self.units[unit_key(unit) if unit is not None
+                   else entry.get('SYSLOG_IDENTIFIER') or '(none)'] += 1
+        self.priorities[entry.get('PRIORITY')] += 1
+        self.rules[rule.name if rule is not None else 'unmatched'] += 1
+
+        if rule is None:
+            self.remaining.add(entry)
+            return
+        if rule.action == 'ignore':
+            return
+
+        for counter in rule.counters:
+            match = counter.message.match(entry['MESSAGE'])
+            if not match:
+                continue
+            if counter.capture:
+                self.counters[counter.name] = match.group(1)
+                self.captured[counter.name] = entry.get('__REALTIME_TIMESTAMP')
+            else:
+                self.counters[counter.name] = self.counters.get(counter.name, 0) + 1
+
+        if rule.group not in self.sections:
+            self.groups.append(rule.group)
+            self.sections[rule.group] = _Section(self.max_templates)
+        self.sections[rule.group].add(entry)
+
+    def merge(self, other):
+        """Add the entries and counters of another digest."""
+        for group in other.groups:
+            if group not in self.sections:
+                self.groups.append(group)
+                self.sections[group] = _Section(self.max_templates)
+            self.sections[group].merge(other.sections[group])
+        self.remaining.merge(other.remaining)
+        for name, value in other.counters.items():
+            if name not in other.captured:
+                self.counters[name] = self.counters.get(name, 0) + value
+                continue
+            # The digests may come from any part of the journal, so the
+            # newest captured value wins, not the last merged one
+            when = other.captured[name]
+            mine = self.captured.get(name)
+            if (name not in self.captured or mine is None
+                    or (when is not None and when >= mine)):
+                self.counters[name] = value
+                self.captured[name] = when
+        self.units.update(other.units)
+        self.priorities.update(other.priorities)
+        self.rules.update(other.rules)
+
+    def metrics(self, since, until):
+        """Return the tallies and counter values as one flat dict."""
+        return {
+            'time': datetime.now().isoformat(),
+            'since': since.isoformat() if since else None,
+            'until': until.isoformat() if until else None,
+            'units': dict(self.units),
+            'priorities': {str(priority): count for priority, count
+                           in self.priorities.items()},
+            'rules': dict(self.rules),
+            'values': self.counters,
+        }
+
+    def is_empty(self):
+        return not self.remaining and not any(self.sections.values())
+
+    def render(self, engine, since, title="Daily journalwatch"):
+        """Return the email body."""
+        lines = [title, ""]
+        for counter in engine.counters:
+            if self.counters.get(counter.name):
+                lines.append(counter.summary.format(self.counters[counter.name]))
+
+        for group in self.groups:
+            lines.append('\n=====================')
+            lines.append('{} logs:'.format(group))
+            lines.extend(self.sections[group].render())
+
+        lines.append('\n=====================')
+        lines.append("Remaining filtered log from {} to now follows:".format(since))
+        lines.extend(self.remaining.render())
+        return '\n'.join(lines)
+
+
+def write_metrics(path, metrics):
+    """Append the metrics of a run to a JSON lines or (*.csv) CSV file.
+
+    The CSV file has one row per value: time, kind, key, value.
+
+    """
+    if path.endswith('.csv'):
+        new_file = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['time', 'kind', 'key', 'value'])
+            for kind in ('units', 'priorities', 'rules', 'values'):
+                for key, value in sorted(metrics[kind].items(), key=str):
+                    writer.writerow([metrics['time'], kind, key, value])
+    else:
+        with open(path, 'a') as f:
+            f.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+
+def build_mail(config, body):
+    """Return the email with the given body."""
+    # Make sure UTF-8 is quoted-printable, not base64
+    # http://stackoverflow.com/questions/9403265/how-do-i-use-python-3-2-email-module-to-send-unicode-messages-encoded-in-utf-8-w/9509718#9509718
+    charset.add_charset('utf-8', charset.QP, charset.QP)
+    mail = MIMEText(body)
+
+    mail['Subject'] = config['subject']
+    mail['To'] = config['to']
+    mail['From'] = config['from']
+    mail['Date'] = email.utils.formatdate(localtime=True)
+    mail['Message-ID'] = email.utils.make_msgid()
+    mail['User-Agent'] = __file__
+    return mail
+
+
+def send_mail(config, body, no_send=False):
+    """Email the body (or print it, with no_send)."""
+    mail = build_mail(config, body)
+    if no_send:
+        print(mail.as_string())
+    else:
+        tls_context = ssl.create_default_context()
+        tls_context.check_hostname = True
+        with SMTP(config['smtp_host'],
+                  config['smtp_port']) as smtp:
+            # smtp.set_debuglevel(True)
+            smtp.starttls(context=tls_context)
+            smtp.login(config['smtp_user'],
+                       config['smtp_pass'])
+            smtp.send_message(mail)
+
+
+def follow(engine, config, state_path, flush_interval, no_send=False,
+           metrics_path=None):
+    """Watch the journal and email a digest of it every flush_interval minutes.
+
+    Entries are classified as they arrive. A kept entry at or above the
+    urgent priority (LOG_ERR unless the config's "urgent_priority" says
+    otherwise) flushes the digest right away, but no more often than every
+    "urgent_holdoff" seconds (default 60) so a crash-looping unit doesn't
+    turn into a mail storm. The metrics, if wanted, are written per digest.
+
+    """
+    urgent_priority = config.get('urgent_priority', journal.LOG_ERR)
+    urgent_holdoff = config.get('urgent_holdoff', 60)
+
+    j = journal.Reader()
+    j.log_level(journal.LOG_INFO)
+    state = load_state(state_path) if state_path else None
+    window = scan_window(state, None)
+    if window.cursor is not None:
+        j.seek_cursor(window.cursor)
+        j.get_next()
+    elif state:
+        j.seek_realtime(window.since)
+    else:
+        j.seek_tail()
+        j.get_previous()
+
+    digest = Digest.from_config(config)
+    since = datetime.now()
+    last_entry = None
+    last_flush = time.monotonic()
+    urgent = False
+
+    def flush():
+        nonlocal digest, since, last_flush, urgent
+        if not digest.is_empty():
+            send_mail(config, digest.render(engine, since, "journalwatch digest"),
+                      no_send)
+        # The cursor moves on first, so a failure below can't make the same
+        # entries go out again
+        if state_path and last_entry is not None:
+            save_state(state_path, last_entry['__CURSOR'],
+                       last_entry['__REALTIME_TIMESTAMP'])
+        if metrics_path:
+            write_metrics(metrics_path, digest.metrics(
+                since, last_entry and last_entry['__REALTIME_TIMESTAMP']))
+        digest = Digest.from_config(config)
+        since = datetime.now()
+        last_flush = time.monotonic()
+        urgent = False
+
+    try:
+        while True:
+            now = time.monotonic()
+            if urgent:
+                timeout = last_flush + urgent_holdoff - now
+            else:
+                timeout = last_flush + flush_interval * 60 - now
+            if timeout > 0:
+                j.wait(timeout)
+
+            for entry in j:
+                rule = engine.classify(entry)
+                digest.add(rule, entry)
+                last_entry = entry
+                if ((rule is None or rule.action != 'ignore') and
+                        entry.get('PRIORITY', journal.LOG_INFO) <= urgent_priority):
+                    urgent = True
+
+            now = time.monotonic()
+            if now - last_flush >= flush_interval * 60 or (
+                    urgent and now - last_flush >= urgent_holdoff):
+                flush()
+    except (KeyboardInterrupt, SystemExit):
+        flush()
 
 
 def main():
@@ -41,6 +1151,39 @@ def main():
 #                        help="Display parsed configuration file")
     parser.add_argument('--no-send', action='store_true',
                         help="Don't send email, just print it")
+    parser.add_argument('--match', action='store_true',
+                        help="Filter with sd-journal matches instead of "
+                        "reading every entry")
+    parser.add_argument('--input', '-i', action='store', nargs='+',
+                        metavar='FILE',
+                        help="Read exported journals instead of the journal "
+                        "('-' for stdin), e.g. from journalctl -o export")
+    parser.add_argument('--input-format', action='store',
+                        choices=('export', 'json'), default='export',
+                        help="format of the --input files (default: %(default)s)")
+    parser.add_argument('--directory', '-D', action='store',
+                        help="Scan the journal files under this directory, "
+                        "e.g. /var/log/journal/remote")
+    parser.add_argument('--jobs', '-j', action='store', type=int, default=1,
+                        help="Scan the journal files in this many processes, "
+                        "0 for one per CPU (default: %(default)s)")
+    parser.add_argument('--follow', '-f', action='store_true',
+                        help="Keep running and email a digest periodically")
+    parser.add_argument('--flush-interval', action='store', type=float,
+                        default=60,
+                        help="minutes between digests with --follow "
+                        "(default: %(default)s)")
+    parser.add_argument('--state', action='store',
+                        help="file to keep the journal cursor in, so the "
+                        "next run resumes where this one stopped (default: "
+                        "the config's state_file, if any)")
+    parser.add_argument('--metrics', action='store',
+                        help="append per-run counts to this JSON lines file "
+                        "(CSV if it ends in .csv) (default: the config's "
+                        "metrics_file, if any)")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Time the full scan against --match, don't "
+                        "send anything")
     parser.add_argument('--version', action='version',
                         version='%(prog)s version {}'.format(__version__))
     args = parser.parse_args()
@@ -49,265 +1192,73 @@ def main():
     with open(args.config) as f:
         config = json.load(f)
 
+    engine = FilterEngine.from_config(config)
+    digest = Digest.from_config(config)
+    metrics_path = args.metrics or config.get('metrics_file')
+
     #################
-    # Define patterns to ignore
+    # Exported journals are processed as a whole, in one pass
     #################
-    # Those are for matching dynamically named units:
-    user_session = re.compile("user@\d+.service")
-    session = re.compile("session-[a-z]?\d+.scope")
-    ssh_unit = re.compile("sshd@[0-9a-f.:]*")
-
-    # Those will match the logged message itself:
-    btsync_deverr = re.compile("UPnP: Device error.*")
-    journal_restart = re.compile("Journal (started|stopped)")
-    login_buttons = re.compile("Watching system buttons .*")
-    attic_backup = re.compile("Archive fingerprint: .*")
-    packages_found = re.compile("Packages \((\d+)\).*")
-    # sshSocketStart = re.compile("(Starting|Stopping) OpenSSH Per-Connection Daemon.*")
-    # ssh_pubkey = re.compile("Accepted publickey for (earl|git).*")
-    # sshReceivedDisconnect = re.compile("Received disconnect from.*")
-    # logindNewSession = re.compile("New session [a-z]?\d+ of user (bob|alice).*")
-    # sshdSessionClosed = re.compile(".*session closed for user (bob|alice).*")
-    # sessionOpenedRoot = re.compile(".*session opened for user root.*")
-    # suSessionClosedGit = re.compile(".*session opened for user git.*")
-    # anacronNormalExit = re.compile("Normal exit (\d+ jobs run).*")
-    # postfixStatistics = re.compile("statistics:.*")
-    # postfixHostnameDoesNotResolve = re.compile("warning: hostname .* does not resolve to address .*: Name or service not known")
+    if args.input:
+        since = until = None
+        for entry in read_files(args.input, args.input_format):
+            if since is None:
+                since = entry['__REALTIME_TIMESTAMP']
+            until = entry['__REALTIME_TIMESTAMP']
+            digest.add(engine.classify(entry), entry)
+        send_mail(config, digest.render(engine, since), args.no_send)
+        if metrics_path:
+            write_metrics(metrics_path, digest.metrics(since, until))
+        return
+
+    if journal is None:
+        parser.error('python-systemd is needed to read the journal')
 
     #################
     # Ready the journal
     #################
-    j = journal.Reader()
-    j.log_level(journal.LOG_INFO)
-    # TODO: Find when the last time this was run instead
+    # Without a saved cursor, look at the past day
     yesterday = datetime.now() - timedelta(days=1, minutes=10)
-    j.seek_realtime(yesterday)
-
-    mail_content = []
-    service_entries = {key: [] for key in
-                       ('attic', 'pacupdate', 'mail', 'timesyncd', 'sshd')}
-    attic_count = 0
-    package_count = None
+    state_path = args.state or config.get('state_file')
+    if args.follow:
+        # systemd stops services with SIGTERM, flush on that too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        follow(engine, config, state_path, args.flush_interval,
+               args.no_send, metrics_path)
+        return
+    state = load_state(state_path) if state_path else None
+    files = None
+    if args.directory:
+        files = journal_files([args.directory])
+    elif args.jobs != 1:
+        files = journal_files(['/var/log/journal', '/run/log/journal'])
+    window = scan_window(state, yesterday, files)
+    if args.benchmark:
+        benchmark(engine, config, window)
+        return
 
     #################
     # Scan through the journal, filter out anything notable
     #################
-    for entry in j:
-        # A log doesn't have a message...? weird
-        if 'MESSAGE' not in entry:
-            line = '{} {}[{}]: empty'
-            line = line.format(datetime.ctime(entry['__REALTIME_TIMESTAMP']),
-                               entry['PRIORITY'], entry['SYSLOG_IDENTIFIER'])
-            mail_content.append(line)
-
-        # With systemd unit name
-        elif '_SYSTEMD_UNIT' in entry:
-            if entry['_SYSTEMD_UNIT'] in ("udisks.service",
-                                          "polkit.service",
-                                          "avahi-daemon.service",
-                                          "bluetooth.service",
-                                          "accounts-daemon.service",
-                                          "rtkit-daemon.service",
-                                          "dbus.service",
-                                          "lightdm.service",
-                                          "systemd-udevd.service",
-                                          "envoy@ssh-agent.service",
-                                          "mkinitcpio-generate-shutdown-ramfs.service"):
-                pass
-            elif user_session.match(entry['_SYSTEMD_UNIT']):
-                pass
-            elif "btsync" in entry['_SYSTEMD_UNIT']:
-                if btsync_deverr.match(entry['MESSAGE']):
-                    pass
-            elif entry['_SYSTEMD_UNIT'] == 'systemd-journald.service':
-                if journal_restart.match(entry['MESSAGE']):
-                    pass
-            elif entry['_SYSTEMD_UNIT'] == 'systemd-logind.service':
-                if login_buttons.match(entry['MESSAGE']):
-                    pass
-            elif session.match(entry['_SYSTEMD_UNIT']):
-                pass
-#            elif sshUnit.match(entry['_SYSTEMD_UNIT']):
-#                if sshAcceptPublicKey.match(entry['MESSAGE']):
-#                    pass
-#                elif sshReceivedDisconnect.match(entry['MESSAGE']):
-#                    pass
-#            elif entry['_SYSTEMD_UNIT'] == "systemd-logind.service":
-#                if logindNewSession.match(entry['MESSAGE']):
-#                    pass
-#            elif entry['_SYSTEMD_UNIT'] == "postfix.service":
-#                if postfixHostnameDoesNotResolve.match(entry['MESSAGE']):
-#                    pass
-            # Attic
-            elif "attic" in entry['_SYSTEMD_UNIT']:
-                if attic_backup.match(entry['MESSAGE']):
-                    attic_count += 1
-
-                service_entries['attic'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            # Count packages
-            elif entry['_SYSTEMD_UNIT'] == 'pacupdate.service':
-                match = packages_found.match(entry['MESSAGE'])
-                if match:
-                    package_count = match.group(1)
-
-                service_entries['pacupdate'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            # timesyncd
-            elif entry['_SYSTEMD_UNIT'] == 'systemd-timesyncd.service':
-                service_entries['timesyncd'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            # sshd
-            elif ssh_unit.match(entry['_SYSTEMD_UNIT']):
-                service_entries['sshd'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            # dovecot
-            elif entry['_SYSTEMD_UNIT'] == 'dovecot.service':
-                service_entries['mail'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            # postfix
-            elif entry['_SYSTEMD_UNIT'] == 'postfix.service':
-                service_entries['mail'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            # other mail types
-            elif entry['_SYSTEMD_UNIT'] in ('opendkim.service', 'spamassassin.service'):
-                service_entries['mail'].append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-            else:
-                mail_content.append('U %s %s %s %s[%s]: %s' % (
-                    entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                    entry['PRIORITY'],
-                    entry['_SYSTEMD_UNIT'],
-                    entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                    entry['_PID'],
-                    entry['MESSAGE']
-                ))
-
-        # With syslog identifier only
-        elif entry['SYSLOG_IDENTIFIER'] in ("systemd",
-                                            "kernel",
-                                            "bluetoothd",
-                                            "systemd-sysctl",
-                                            "systemd-journald",
-                                            "systemd-udevd",
-                                            "ntpd", "mtp-probe"):
-            pass
-#            if sshSocketStart.match(entry['MESSAGE']):
-#                pass
-#            # elif firewalldStart.match(entry['MESSAGE']):
-#            #     pass
-#        elif entry['SYSLOG_IDENTIFIER'] == "sshd":
-#            if sshdSessionClosed.match(entry['MESSAGE']):
-#                pass
-#        elif entry['SYSLOG_IDENTIFIER'] == "sudo":
-#            if sessionOpenedRoot.match(entry['MESSAGE']):
-#                pass
-#        elif entry['SYSLOG_IDENTIFIER'] == "postfix/anvil":
-#            if postfixStatistics.match(entry['MESSAGE']):
-#                pass
-#        elif entry['SYSLOG_IDENTIFIER'] == "su":
-#            if suSessionClosedGit.match(entry['MESSAGE']):
-#                pass
+    if args.jobs != 1:
+        digest = scan_parallel(config, window, files, args.jobs, args.match)
+    else:
+        if args.match:
+            entries = scan_matched(engine, window, files)
         else:
-            mail_content.append('S %s %s %s: %s' % (
-                entry['__REALTIME_TIMESTAMP'].strftime("%a %b %d %I:%m:%S %p"),
-                entry['PRIORITY'],
-                entry.get('SYSLOG_IDENTIFIER', 'UNKNOWN'),
-                entry['MESSAGE']
-            ))
-
-    # Create summary message
-    mail_summary = "Daily journalwatch\n\n"
-    if attic_count:
-        mail_summary += "attic backed up {} times".format(attic_count)
-    if package_count:
-        mail_summary += "pacupdate found {} packages to update\n".format(package_count)
-
-    for service in ('attic', 'pacupdate', 'sshd', 'mail', 'timesyncd'):
-        mail_summary += '\n=====================\n'
-        mail_summary += '{} logs:\n'.format(service)
-        mail_summary += '\n'.join(service_entries[service])
-        mail_summary += '\n'
-
-    mail_summary += '\n=====================\n'
-    mail_summary += "Remaining filtered log from {} to now follows:\n".format(yesterday)
-    # TODO: Also count ssh, nginx, dovecot, postfix info (logins passed and failed, etc)
+            entries = scan_full(window, files)
+        for entry in entries:
+            digest.add(engine.classify(entry), entry)
 
-    #################
-    # Send email
-    #################
-    # Make sure UTF-8 is quoted-printable, not base64
-    # http://stackoverflow.com/questions/9403265/how-do-i-use-python-3-2-email-module-to-send-unicode-messages-encoded-in-utf-8-w/9509718#9509718
-    charset.add_charset('utf-8', charset.QP, charset.QP)
-    mail = MIMEText(mail_summary + '\n'.join(mail_content))
+    send_mail(config, digest.render(engine, window.since), args.no_send)
 
-    mail['Subject'] = config['subject']
-    mail['To'] = config['to']
-    mail['From'] = config['from']
-    mail['Date'] = email.utils.formatdate(localtime=True)
-    mail['Message-ID'] = email.utils.make_msgid()
-    mail['User-Agent'] = __file__
-    if args.no_send:
-        print(mail.as_string())
-    else:
-        tls_context = ssl.create_default_context()
-        tls_context.check_hostname = True
-        with SMTP(config['smtp_host'],
-                  config['smtp_port']) as smtp:
-            # smtp.set_debuglevel(True)
-            smtp.starttls(context=tls_context)
-            smtp.login(config['smtp_user'],
-                       config['smtp_pass'])
-            smtp.send_message(mail)
+    # Only move the cursor on once the email is out, and before anything else
+    # can fail, so the same entries aren't sent again
+    if state_path and window.until_cursor is not None:
+        save_state(state_path, window.until_cursor, window.until)
+
+    if metrics_path:
+        write_metrics(metrics_path, digest.metrics(window.since, window.until))
 
     return
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Measure journalwatch's throughput offline.
+
+The filter engine and digest are fed either from an exported journal
+(``journalctl -o export`` or ``journalctl -o json``) or from a seeded
+synthetic journal that mimics the unit mix of our hosts. The time spent in
+each stage, the throughput and the peak RSS are reported. Nothing is sent,
+the email is only built (and printed with --print).
+
+Neither a live journal nor python-systemd is needed.
+
+"""
+__author__ = 'Rich Li'
+__version__ = 0.3
+
+# Version history:
+# v0.1 2026-10-18: Started
+# v0.2 2026-10-18: Use journalwatch's own export/JSON readers
+# v0.3 2026-10-18: Give the synthetic entries a _TRANSPORT, like journald does
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import random
+import resource
+import time
+
+import journalwatch
+
+# The synthetic journal: (weight, unit, syslog identifier, messages). A unit of
+# None makes an entry without a unit: the kernel's, or PID 1's on a systemd
+# without init.scope. The placeholders are filled in with random values for
+# each entry.
+UNIT_MIX = [
+    (20, None, 'kernel',
+     ['usb {n}-{n}: new high-speed USB device number {n} using xhci_hcd',
+      'EXT4-fs (sda{n}): re-mounted. Opts: (null)',
+      'audit: type=1130 audit({n}.{n}:{n}): pid=1 uid=0 msg=\'unit=foo\'']),
+    (10, None, 'systemd',
+     ['Started Session {n} of user earl.', 'Starting Cleanup of Temporary Directories...']),
+    (3, 'session-c{n}.scope', 'sudo',
+     ['earl : TTY=pts/{n} ; PWD=/home/earl ; USER=root ; COMMAND=/usr/bin/pacman -Syu']),
+    (8, 'dbus.service', 'dbus-daemon',
+     ['[system] Activating via systemd: service name=\'org.freedesktop.hostname1\'']),
+    (6, 'udisks.service', 'udisksd', ['Mounted /dev/sdb{n} at /run/media/earl/{hex}']),
+    (6, 'user@{uid}.service', 'systemd', ['Reached target Default.', 'Started {hex}.']),
+    (6, 'session-c{n}.scope', 'sudo', ['pam_unix(sudo:session): session opened for user root']),
+    (10, 'sshd@{n}-{ip}:22-{peer}:{port}.service', 'sshd',
+     ['Failed password for root from {peer} port {port} ssh2',
+      'Invalid user admin from {peer} port {port}',
+      'Accepted publickey for earl from {peer} port {port} ssh2',
+      'Received disconnect from {peer} port {port}:11: Bye Bye [preauth]']),
+    (8, 'dovecot.service', 'dovecot',
+     ['imap-login: Login: user=<earl>, method=PLAIN, rip={peer}, lip={ip}, mpid={n}, TLS',
+      'imap-login: Disconnected (auth failed, 1 attempts in 2 secs): user=<admin>, rip={peer}']),
+    (8, 'postfix.service', 'postfix/smtpd',
+     ['connect from unknown[{peer}]',
+      'warning: unknown[{peer}]: SASL LOGIN authentication failed: authentication failure',
+      '{hex}: client=unknown[{peer}], sasl_method=PLAIN, sasl_username=earl']),
+    (2, 'attic.service', 'attic',
+     ['Archive fingerprint: {hex}{hex}', 'Number of files: {n}']),
+    (1, 'pacupdate.service', 'pacupdate', ['Packages ({n}) linux-{n}.{n} systemd-{n}']),
+    (3, 'systemd-timesyncd.service', 'systemd-timesyncd',
+     ['Synchronized to time server {ip}:123 (0.arch.pool.ntp.org).']),
+    (3, 'systemd-journald.service', 'systemd-journald',
+     ['Journal started', 'Runtime journal is using {n}.0M (max allowed 391.1M).']),
+    (5, 'nginx.service', 'nginx', ['{peer} - - "GET /{hex} HTTP/1.1" 404 162']),
+    (4, 'crashloop.service', 'crashloop',
+     ['Main process exited, code=exited, status={n}/FAILURE']),
+]
+
+# Relative frequency of each priority in the synthetic journal
+PRIORITY_MIX = [(3, 1), (4, 2), (5, 3), (6, 10), (7, 4)]
+
+
+def synthetic_journal(count, seed=0):
+    """Yield count entries of a synthetic journal, the same for every seed."""
+    rng = random.Random(seed)
+    weights = [mix[0] for mix in UNIT_MIX]
+    priorities = [mix[0] for mix in PRIORITY_MIX]
+    priority_weights = [mix[1] for mix in PRIORITY_MIX]
+    realtime = datetime(2015, 3, 6)
+
+    def ip():
+        return '.'.join(str(rng.randrange(256)) for _ in range(4))
+
+    for index in range(count):
+        _, unit, identifier, messages = rng.choices(UNIT_MIX, weights)[0]
+        values = {'n': rng.randrange(1000), 'uid': rng.choice((0, 1000, 1001)),
+                  'ip': '10.0.0.1', 'peer': ip(), 'port': rng.randrange(1024, 65536),
+                  'hex': '{:08x}'.format(rng.getrandbits(32))}
+        realtime += timedelta(microseconds=rng.randrange(100000))
+        entry = {
+            '__REALTIME_TIMESTAMP': realtime,
+            '__CURSOR': 's=0;i={:x}'.format(index),
+            'PRIORITY': rng.choices(priorities, priority_weights)[0],
+            'SYSLOG_IDENTIFIER': identifier,
+            '_PID': rng.randrange(1, 32768),
+            'MESSAGE': rng.choice(messages).format(**values),
+            '_TRANSPORT': 'kernel' if identifier == 'kernel' else 'journal',
+        }
+        if unit is not None:
+            entry['_SYSTEMD_UNIT'] = unit.format(**values)
+        yield entry
+
+
+def write_json(entries, f):
+    """Write entries in the format of journalctl -o json."""
+    for entry in entries:
+        fields = dict(entry)
+        fields['__REALTIME_TIMESTAMP'] = str(int(
+            entry['__REALTIME_TIMESTAMP'].timestamp() * 1e6))
+        for name in ('PRIORITY', '_PID'):
+            if name in fields:
+                fields[name] = str(fields[name])
+        f.write(json.dumps(fields) + '\n')
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark journalwatch on an exported or synthetic journal')
+    parser.add_argument('--config', '-c', action='store',
+                        help='journalwatch json config file (default: the '
+                        'built-in rules)')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--export', action='store', metavar='FILE',
+                        help='replay a journalctl -o export file ("-" for stdin)')
+    source.add_argument('--json', action='store', metavar='FILE',
+                        help='replay a journalctl -o json file ("-" for stdin)')
+    parser.add_argument('--entries', '-n', action='store', type=int,
+                        default=1000000,
+                        help='size of the synthetic journal (default: %(default)s)')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='seed of the synthetic journal (default: %(default)s)')
+    parser.add_argument('--write-corpus', action='store', metavar='FILE',
+                        help='write the synthetic journal as JSON to replay '
+                        'later, then exit')
+    parser.add_argument('--print', action='store_true',
+                        help='print the email at the end')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s version {}'.format(__version__))
+    args = parser.parse_args()
+
+    config = {'subject': 'journalwatch benchmark', 'to': 'root@localhost',
+              'from': 'root@localhost'}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    if args.write_corpus:
+        with open(args.write_corpus, 'w') as f:
+            write_json(synthetic_journal(args.entries, args.seed), f)
+        return
+
+    stages = []
+
+    # Read (what sd-journal's log_level() would do included)
+    start = time.perf_counter()
+    if args.export:
+        entries = list(journalwatch.read_files([args.export], 'export'))
+    elif args.json:
+        entries = list(journalwatch.read_files([args.json], 'json'))
+    else:
+        entries = [entry for entry in synthetic_journal(args.entries, args.seed)
+                   if entry['PRIORITY'] <= 6]
+    stages.append(('read', time.perf_counter() - start))
+
+    # Classify
+    start = time.perf_counter()
+    engine = journalwatch.FilterEngine.from_config(config)
+    digest = journalwatch.Digest.from_config(config)
+    for entry in entries:
+        digest.add(engine.classify(entry), entry)
+    stages.append(('classify', time.perf_counter() - start))
+
+    # Format
+    start = time.perf_counter()
+    since = entries[0]['__REALTIME_TIMESTAMP'] if entries else datetime.now()
+    body = digest.render(engine, since)
+    stages.append(('format', time.perf_counter() - start))
+
+    # Build MIME
+    start = time.perf_counter()
+    mail = journalwatch.build_mail(config, body).as_string()
+    stages.append(('build MIME', time.perf_counter() - start))
+
+    if args.print:
+        print(mail)
+
+    print('{:<12} {:>10} {:>14}'.format('stage', 'seconds', 'entries/s'))
+    for name, elapsed in stages + [('total', sum(e for _, e in stages))]:
+        print('{:<12} {:>10.3f} {:>14.0f}'.format(
+            name, elapsed, len(entries) / elapsed if elapsed else 0))
+    print('{} entries, {} byte email, peak RSS {:0.1f} MiB'.format(
+        len(entries), len(mail),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,792 @@
 #!/usr/bin/env python
 from __future__ import division, print_function
 __author__ = 'Rich Li'
-__version__ = 0.1
+__version__ = 0.6
+
+# Version history
+# v0.1: Started
+# v0.2 2026-10-18: Count seen/unseen from the Maildir file names alone
+# v0.3 2026-10-18: Read only the headers, in bounded chunks, and decode them
+# v0.4 2026-10-18: Keep a sqlite index per account, rescan changed dirs only
+# v0.5 2026-10-18: --daemon watches the maildirs with inotify, --query asks it
+# v0.6 2026-10-18: Accounts and folder globs from a config, parallel scan, --json
 
 import argparse
-import os.path
-import mailbox
+import concurrent.futures
+import configparser
+import ctypes
+import ctypes.util
+import email.errors
+import email.header
+import errno
+import fnmatch
+import json
+import os
+import selectors
+import signal
+import socket
+import sqlite3
+import struct
+import sys
+import time
+
+# Headers are read this many bytes at a time, and no more than HEADER_LIMIT of
+# them: a message without a blank line (or a huge header block) can't make us
+# read the whole file.
+HEADER_CHUNK = 4096
+HEADER_LIMIT = 256 * 1024
+
+# What's scanned when there's no config file: the INBOX of these accounts
+MAILROOT = '/home/earl/.mutt/offlineimap'
+ACCOUNTS = ['dranek', 'mers', 'onion.avenger', 'rich.lindsley', 'richli.ff']
+CONFIG_PATH = os.path.expanduser('~/.config/parse_new_mails.ini')
+
+# How many folders are scanned at once (it's mostly waiting on the disk)
+JOBS = 16
+
+# Where the per-folder indexes live
+CACHE_DIR = os.path.expanduser('~/.cache/parse_new_mails')
+
+# Where --daemon serves the report, and the file it keeps it in
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', CACHE_DIR),
+        'parse_new_mails.sock')
+SNAPSHOT_PATH = os.path.join(CACHE_DIR, 'snapshot.txt')
+
+# How many of the newest unseen messages --daemon shows the headers of
+RECENT_HEADERS = 10
+
+# How often (seconds) --daemon retries a maildir it couldn't watch
+RETRY_INTERVAL = 60
+
+# Bump when the index's tables change; an index of another version is rebuilt
+INDEX_VERSION = 1
+
+# The Maildir subdirectories holding messages
+SUBDIRS = ('new', 'cur')
+
+def load_config(path):
+    """ Read the accounts config; returns None if there's no such file
+
+    Each section is an account, whose Maildir folders are under <path>
+    (default <mailroot>/<account>). folders is a comma-separated list of
+    globs matched against the folder names, e.g. "INBOX, Lists.*" or "*".
+    Options in [DEFAULT] apply to every account:
+
+        [DEFAULT]
+        mailroot = /home/earl/.mutt/offlineimap
+        folders = INBOX
+
+        [dranek]
+        folders = *
+
+    """
+    cfg = configparser.ConfigParser(defaults={'mailroot': MAILROOT,
+        'folders': 'INBOX'})
+    if not cfg.read(path):
+        return None
+    return cfg
+
+def default_config():
+    """ The config used without a file: the INBOX of ACCOUNTS """
+    cfg = configparser.ConfigParser(defaults={'mailroot': MAILROOT,
+        'folders': 'INBOX'})
+    cfg.read_dict({acct: {} for acct in ACCOUNTS})
+    return cfg
+
+def find_folders(root, globs):
+    """ List the Maildir folders under root whose names match a glob
+
+    A folder is any directory with cur/ and new/ in it, at any depth (for
+    offlineimap's "/" separator); its name is its path relative to root.
+    Returns the names sorted, INBOX first.
+
+    """
+    folders = []
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        try:
+            subdirs = [entry.name for entry in os.scandir(os.path.join(root, rel))
+                    if entry.is_dir()]
+        except FileNotFoundError:
+            continue
+        if rel and 'cur' in subdirs and 'new' in subdirs:
+            if any(fnmatch.fnmatchcase(rel, glob) for glob in globs):
+                folders.append(rel)
+        pending.extend(os.path.join(rel, name) for name in subdirs
+                if name not in ('cur', 'new', 'tmp'))
+    return sorted(folders, key=lambda folder: (folder != 'INBOX', folder))
+
+def config_folders(cfg, pool):
+    """ Find the folders of every account, in parallel
+
+    Returns a list of (account, folder, path) in the config's order.
+
+    """
+    jobs = []
+    for acct in cfg.sections():
+        root = cfg.get(acct, 'path', fallback=os.path.join(
+            cfg.get(acct, 'mailroot'), acct))
+        globs = [glob.strip() for glob in cfg.get(acct, 'folders').split(',')
+                if glob.strip()]
+        jobs.append((acct, root, pool.submit(find_folders, root, globs)))
+    return [(acct, folder, os.path.join(root, folder))
+            for acct, root, job in jobs for folder in job.result()]
+
+def folder_label(acct, folder):
+    """ How a folder is named in the report (just the account for INBOX) """
+    return acct if folder == 'INBOX' else '{}/{}'.format(acct, folder)
+
+def split_name(name):
+    """ Split a Maildir file name into its unique part and its flags
+
+    Maildir keeps the flags in the file name ("<unique>:2,<flags>"), and
+    messages in new/ have none yet.
+
+    """
+    unique, sep, flags = name.partition(':2,')
+    return unique, flags if sep else ''
+
+def scan_maildir(path):
+    """ Count a Maildir's messages and find the unseen ones
+
+    Maildir keeps the flags in the file names ("<unique>:2,<flags>", and
+    messages in new/ have none yet), so only the directories are listed; no
+    message is opened. Returns the total count and the paths of the unseen
+    messages, oldest first.
+
+    """
+    total = 0
+    unseen = []
+    for subdir in SUBDIRS:
+        for entry in os.scandir(os.path.join(path, subdir)):
+            if entry.name.startswith('.'):
+                continue
+            total += 1
+            if 'S' not in split_name(entry.name)[1]:
+                unseen.append((entry.name, entry.path))
+    return total, [path for _, path in sorted(unseen)]
+
+def read_header_block(f):
+    """ Read a message's header block, without the body
+
+    Reads HEADER_CHUNK bytes at a time until the blank line that ends the
+    headers (or EOF, or HEADER_LIMIT). Whatever of the body the last chunk
+    brought along is dropped.
+
+    """
+    block = bytearray()
+    while len(block) < HEADER_LIMIT:
+        chunk = f.read(HEADER_CHUNK)
+        if not chunk:
+            break
+        # The blank line may straddle two chunks
+        start = max(0, len(block) - 3)
+        block += chunk
+        for blank in (b'\n\n', b'\r\n\r\n'):
+            end = block.find(blank, start)
+            if end >= 0:
+                del block[end + 1:]
+                return bytes(block)
+    return bytes(block[:HEADER_LIMIT])
+
+def unfold_headers(block, wanted):
+    """ Unfold the header lines of a block, keeping the wanted fields
+
+    Returns a dict of lowercase field name to raw (still encoded) value; the
+    first occurrence of a field wins.
+
+    """
+    fields = {}
+    name = None
+    for line in block.decode('utf-8', 'replace').splitlines():
+        if line[:1] in (' ', '\t'):
+            # Continuation of the previous field
+            if name is not None:
+                fields[name] += line
+            continue
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        if not sep or name not in wanted or name in fields:
+            name = None
+            continue
+        fields[name] = value.strip()
+    return fields
+
+def decode_header_value(value):
+    """ Decode RFC 2047 encoded words ("=?utf-8?q?...?=") in a header value """
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (email.errors.HeaderParseError, LookupError, UnicodeError):
+        # Broken encoded word or unknown charset: show it as it is
+        return value
+
+def read_headers(path, wanted=('from', 'subject')):
+    """ Read some header fields of a message, or return None if it's gone
+
+    Only the header block is read (see read_header_block), so the cost
+    doesn't depend on the size of the body. Returns a dict of the wanted
+    fields present, decoded, with lowercase names.
+
+    """
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            block = read_header_block(f)
+    except FileNotFoundError:
+        # A mail reader moved it since the directory was listed
+        return None
+    fields = unfold_headers(block, wanted)
+    return {name: decode_header_value(value) for name, value in fields.items()}
+
+class maildir_index(object):
+    """ An on-disk index of a Maildir's messages
+
+    The index (sqlite) maps each message's unique name to where it is, its
+    flags and, once they're needed, its From, Subject and Date. It remembers
+    the mtime of new/ and cur/: any delivery, removal or flag change (a
+    rename) touches the directory, so a directory whose mtime hasn't changed
+    isn't listed again. On an unchanged Maildir, update() is two stat calls.
+
+    """
+
+    def __init__(self, path, db_path):
+        self.path = path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != INDEX_VERSION:
+            with self.db:
+                self.db.execute('DROP TABLE IF EXISTS dirs')
+                self.db.execute('DROP TABLE IF EXISTS messages')
+                self.db.execute('CREATE TABLE dirs (subdir TEXT PRIMARY KEY, '
+                        'mtime_ns INTEGER)')
+                # sender is NULL until the headers have been read
+                self.db.execute('CREATE TABLE messages (uniq TEXT PRIMARY KEY, '
+                        'subdir TEXT, name TEXT, flags TEXT, '
+                        'sender TEXT, subject TEXT, date TEXT)')
+                self.db.execute('PRAGMA user_version = {}'.format(INDEX_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self):
+        """ Bring the index up to date with the directories that changed """
+        mtimes = dict(self.db.execute('SELECT subdir, mtime_ns FROM dirs'))
+        changed = {}
+        for subdir in SUBDIRS:
+            mtime_ns = os.stat(os.path.join(self.path, subdir)).st_mtime_ns
+            if mtimes.get(subdir) != mtime_ns:
+                changed[subdir] = mtime_ns
+        if not changed:
+            return
+
+        # List the changed directories
+        listed = {}
+        for subdir in changed:
+            for entry in os.scandir(os.path.join(self.path, subdir)):
+                if not entry.name.startswith('.'):
+                    unique, flags = split_name(entry.name)
+                    listed[unique] = (subdir, entry.name, flags)
+
+        with self.db:
+            # Drop what left the changed directories and isn't elsewhere now
+            # (a message moved from new/ to cur/ keeps its cached headers)
+            for unique, subdir in self.db.execute(
+                    'SELECT uniq, subdir FROM messages WHERE subdir IN ({})'.format(
+                        ','.join('?' * len(changed))), list(changed)).fetchall():
+                if unique not in listed:
+                    self.db.execute('DELETE FROM messages WHERE uniq = ?', (unique,))
+            self.db.executemany('INSERT INTO messages (uniq, subdir, name, flags) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (uniq) DO UPDATE SET '
+                    'subdir = excluded.subdir, name = excluded.name, '
+                    'flags = excluded.flags',
+                    ((unique,) + where for unique, where in listed.items()))
+            now_ns = time.time_ns()
+            for subdir, mtime_ns in changed.items():
+                # A directory changed within the last second could change
+                # again without its mtime moving (coarse timestamps), so
+                # don't trust it yet
+                if now_ns - mtime_ns < 1000000000:
+                    mtime_ns = None
+                self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                        (subdir, mtime_ns))
+
+    def total(self):
+        """ Count the messages """
+        return self.db.execute('SELECT count(*) FROM messages').fetchone()[0]
+
+    def unseen(self):
+        """ Return the headers of the unseen messages, oldest first
+
+        Each is a dict with the from, subject and date present. Headers not
+        in the index yet are read from the messages and stored; a message
+        gone since the last update() gives None.
+
+        """
+        rows = self.db.execute('SELECT uniq, subdir, name, sender, subject, '
+                'date FROM messages WHERE instr(flags, ?) = 0 ORDER BY name',
+                # Not LIKE: it ignores case, and lowercase flags are keywords
+                ('S',)).fetchall()
+        result = []
+        with self.db:
+            for unique, subdir, name, sender, subject, date in rows:
+                if sender is None:
+                    msg = read_headers(os.path.join(self.path, subdir, name),
+                            ('from', 'subject', 'date'))
+                    if msg is None:
+                        result.append(None)
+                        continue
+                    sender, subject, date = (msg.get('from', ''),
+                            msg.get('subject'), msg.get('date'))
+                    self.db.execute('UPDATE messages SET sender = ?, subject = ?, '
+                            'date = ? WHERE uniq = ?',
+                            (sender, subject, date, unique))
+                msg = {'subject': subject, 'date': date}
+                if sender:
+                    msg['from'] = sender
+                result.append({name: value for name, value in msg.items()
+                        if value is not None})
+        return result
+
+def report(acct, total, new_cnt, unseen, show_all):
+    """ Return the text showing an account's counts and new messages
+
+    unseen are the headers (dicts, or None for a message that's gone) of the
+    new messages to show; there can be fewer of them than new_cnt.
+
+    """
+    # Store some info about the new messages
+    new_text = []
+    for msg in unseen:
+        if msg is None:
+            continue
+        msg_text = []
+        if 'from' in msg:
+            msg_text.append("  From: {}".format(msg['from']))
+        if 'subject' in msg:
+            msg_text.append("  Subject: {}".format(msg['subject']))
+#        if 'date' in msg:
+#            print("Date: {}".format(msg['date']))
+        msg_text.append("----")
+        new_text.append("\n".join(msg_text))
+
+    # Display totals, info from new messages
+    lines = []
+    if show_all:
+        if new_cnt:
+            lines.append("{}: {}/{}".format(acct, new_cnt, total))
+            lines.extend(new_text)
+        else:
+            lines.append("{}: {}".format(acct, total))
+    else:
+        if new_cnt:
+            lines.append("{} new mail on {}".format(new_cnt, acct))
+            lines.extend(new_text)
+    return "".join(line + "\n" for line in lines)
+
+class inotify(object):
+    """ A Linux inotify instance, through libc """
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        """ Watch a directory; returns the watch descriptor """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                mask | self.IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self):
+        """ Yield the pending events as (wd, mask, name) """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+class maildir_watch(object):
+    """ An account's Maildir kept in memory from inotify events
+
+    The flags of every message come from the file names as they're created,
+    renamed and deleted, so the counts are always at hand. Headers are only
+    read for the RECENT_HEADERS newest unseen messages, and kept until the
+    message is seen or gone.
+
+    """
+
+    MASK = (inotify.IN_CREATE | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM
+            | inotify.IN_MOVED_TO | inotify.IN_DELETE | inotify.IN_DELETE_SELF
+            | inotify.IN_MOVE_SELF)
+
+    def __init__(self, acct, path):
+        self.acct = acct
+        self.path = path
+        self.flags = {}     # unique name -> (subdir, file name, flags)
+        self.unseen = set()
+        self.headers = {}   # unique name -> headers, for some unseen ones
+        self.watches = {}   # wd -> subdir
+
+    def watch(self, notifier):
+        """ Watch new/ and cur/, then list them
+
+        Watching comes first so that nothing changing meanwhile is missed.
+
+        """
+        for subdir in SUBDIRS:
+            if subdir not in self.watches.values():
+                wd = notifier.add_watch(os.path.join(self.path, subdir), self.MASK)
+                self.watches[wd] = subdir
+        self.scan()
+
+    def scan(self):
+        """ List new/ and cur/ from scratch """
+        self.flags.clear()
+        self.unseen.clear()
+        for subdir in SUBDIRS:
+            for entry in os.scandir(os.path.join(self.path, subdir)):
+                self.add(subdir, entry.name)
+        for unique in set(self.headers) - self.unseen:
+            del self.headers[unique]
+
+    def add(self, subdir, name):
+        if name.startswith('.'):
+            return
+        unique, flags = split_name(name)
+        self.flags[unique] = (subdir, name, flags)
+        if 'S' in flags:
+            self.unseen.discard(unique)
+            self.headers.pop(unique, None)
+        else:
+            self.unseen.add(unique)
+
+    def remove(self, subdir, name):
+        unique, _ = split_name(name)
+        # A rename in the same batch may already have added the new name
+        if self.flags.get(unique, (None, None))[:2] == (subdir, name):
+            del self.flags[unique]
+            self.unseen.discard(unique)
+            self.headers.pop(unique, None)
+
+    def event(self, wd, mask, name):
+        """ Apply an inotify event; returns False if the watch is gone """
+        subdir = self.watches[wd]
+        if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            self.add(subdir, name)
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.remove(subdir, name)
+        elif mask & inotify.IN_CLOSE_WRITE:
+            # Created in place and now written: what was read may be partial
+            self.headers.pop(split_name(name)[0], None)
+        if mask & inotify.IN_IGNORED:
+            del self.watches[wd]
+            return False
+        return True
+
+    def report(self, show_all):
+        recent = sorted(self.unseen, key=lambda unique: self.flags[unique][1])
+        unseen = []
+        for unique in recent[-RECENT_HEADERS:]:
+            if unique not in self.headers:
+                subdir, name, _ = self.flags[unique]
+                self.headers[unique] = read_headers(os.path.join(self.path,
+                        subdir, name))
+            unseen.append(self.headers[unique])
+        return report(self.acct, len(self.flags), len(self.unseen), unseen,
+                show_all)
+
+def write_atomically(path, text):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def daemon(find, show_all, socket_path, snapshot_path):
+    """ Keep the report up to date from inotify events and serve it
+
+    find returns the folders to watch as (account, folder, path), like
+    config_folders; it's called again every RETRY_INTERVAL, so accounts and
+    folders created later are picked up. The report (with show_all or not)
+    is written to snapshot_path each time it changes. Whoever connects to
+    the Unix socket at socket_path gets the one they ask for (see query).
+    Runs until SIGTERM or SIGINT.
+
+    """
+    notifier = inotify()
+    maildirs = {}   # path -> maildir_watch, of every folder found so far
+    shown = []      # the maildirs found last time, in the config's order
+    by_wd = {}
+    errors = {}     # acct -> why its maildir can't be watched
+
+    def failed(maildir, action, e):
+        # Only say it once, not on every retry
+        if errors.get(maildir.acct) != e.strerror:
+            errors[maildir.acct] = e.strerror
+            print("{}: can't {} {}: {}".format(maildir.acct, action,
+                maildir.path, e.strerror), file=sys.stderr)
+
+    def watch_all():
+        shown[:] = []
+        for acct, folder, path in find():
+            if path not in maildirs:
+                maildirs[path] = maildir_watch(folder_label(acct, folder), path)
+            shown.append(maildirs[path])
+        for maildir in shown:
+            if len(maildir.watches) == len(SUBDIRS):
+                continue
+            try:
+                maildir.watch(notifier)
+                errors.pop(maildir.acct, None)
+            except OSError as e:
+                failed(maildir, "watch", e)
+            by_wd.update(dict.fromkeys(maildir.watches, maildir))
+
+    for path in (socket_path, snapshot_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    server.setblocking(False)
+
+    sel = selectors.DefaultSelector()
+    sel.register(notifier, selectors.EVENT_READ)
+    sel.register(server, selectors.EVENT_READ)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        watch_all()
+        text = None
+        last_retry = time.monotonic()
+        while True:
+            # Refresh the reports after each batch of events
+            texts = {show: "".join(maildir.report(show) for maildir in shown
+                    if maildir.watches) for show in (False, True)}
+            if texts[show_all] != text:
+                text = texts[show_all]
+                write_atomically(snapshot_path, text)
+
+            for key, _ in sel.select(RETRY_INTERVAL):
+                if key.fileobj is server:
+                    try:
+                        conn, _ = server.accept()
+                    except BlockingIOError:
+                        continue
+                    with conn:
+                        conn.settimeout(1)
+                        try:
+                            request = conn.recv(16)
+                            conn.sendall(texts[request.strip() == b"all"].encode())
+                        except OSError:
+                            pass
+                    continue
+                for wd, mask, name in notifier.read():
+                    if mask & inotify.IN_Q_OVERFLOW:
+                        # Events were lost
+                        for maildir in maildirs.values():
+                            if not maildir.watches:
+                                continue
+                            try:
+                                maildir.scan()
+                            except OSError as e:
+                                # Drop it for watch_all() to retry, like one
+                                # that couldn't be watched
+                                failed(maildir, "scan", e)
+                                for wd in maildir.watches:
+                                    by_wd.pop(wd, None)
+                                maildir.watches.clear()
+                    elif wd in by_wd and not by_wd[wd].event(wd, mask, name):
+                        del by_wd[wd]
+
+            # Look for new folders, and try again those that went away (or
+            # never were) now and then
+            if time.monotonic() - last_retry > RETRY_INTERVAL:
+                last_retry = time.monotonic()
+                watch_all()
+    finally:
+        sel.close()
+        server.close()
+        notifier.close()
+        os.remove(socket_path)
+
+def query(socket_path, show_all):
+    """ Return the report from a running --daemon, or None if none is
+
+    It's the report of all the folders if show_all, otherwise only of those
+    with new mail, whatever the daemon's own --show_all.
+
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(1)
+        client.connect(socket_path)
+        client.sendall(b"all\n" if show_all else b"new\n")
+        data = []
+        while True:
+            chunk = client.recv(64 * 1024)
+            if not chunk:
+                break
+            data.append(chunk)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    finally:
+        client.close()
+    return b"".join(data).decode()
+
+def scan_folder(path, db_path):
+    """ Count a folder's messages and read the unseen ones' headers
+
+    Uses the index at db_path, or scans from scratch if it's None. Returns
+    the total and the unseen messages' headers (see maildir_index.unseen).
+
+    """
+    if db_path is None:
+        total, unseen = scan_maildir(path)
+        return total, [read_headers(msg_path, ('from', 'subject', 'date'))
+                for msg_path in unseen]
+    with maildir_index(path, db_path) as index:
+        index.update()
+        return index.total(), index.unseen()
 
 def main():
     """ Scan local maildirs for new mail
-    
-    For the local maildirs hardcoded below, we open each folder and scan for
-    new messages. Info from the new messages (from, subject) is stored and
-    then the total message count and new message count is diplayed for each
-    account. The info from the new messages is also displayed.
+
+    For the accounts and folders in the config (or the INBOX of the accounts
+    hardcoded above, without one), we open each folder and scan for new
+    messages. Info from the new messages (from, subject) is stored and then
+    the total message count and new message count is diplayed for each
+    folder. The info from the new messages is also displayed. With --json,
+    all that is printed as JSON instead.
+
+    Only the unseen messages are opened, the counts come from the file names.
+    Both are kept in an index per folder (see maildir_index), so a run on an
+    unchanged maildir only stats its directories. The folders are found and
+    scanned in a thread pool, since it's mostly waiting on the disk.
+
+    With --daemon, the maildirs are watched with inotify instead, and the
+    report is kept in a snapshot file and served on a Unix socket; --query
+    (or just reading the snapshot) gets it without any scan.
 
     This is designed to be used as a tooltip for awesomewm.
     """
     # Parse args
     parser = argparse.ArgumentParser(description="Check maildirs for new mail")
     parser.add_argument('--show_all', action='store_true',
-            help='Display info from all mailboxes, otherwise only new mail')
+            help='Display info from all mailboxes, otherwise only new mail '
+            '(with --daemon, in the snapshot; --query asks for either)')
+    parser.add_argument('--config', '-c', default=CONFIG_PATH,
+            help='The accounts and folders to scan (default: %(default)s, or '
+            'the INBOX of the built-in accounts if it doesn\'t exist)')
+    parser.add_argument('--jobs', '-j', type=int, default=JOBS,
+            help='How many folders to scan at once (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+            help='Print the counts and new messages of every folder as JSON')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+            help='Where to keep the index of each folder (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+            help='Scan the maildirs from scratch, without the index')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--daemon', action='store_true',
+            help='Watch the maildirs and serve the report on --socket and '
+            'in --snapshot')
+    mode.add_argument('--query', action='store_true',
+            help='Get the report from the daemon (scan if none is running)')
+    parser.add_argument('--socket', default=SOCKET_PATH,
+            help='Unix socket of the daemon (default: %(default)s)')
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH,
+            help='File the daemon keeps the report in (default: %(default)s)')
     parser.add_argument('--version', action='version', 
             version='%(prog)s version {}'.format(__version__))
     args = parser.parse_args()
+    if args.daemon and args.json:
+        parser.error("--daemon only serves the text report, not --json")
+
+    if args.query and not args.json:
+        text = query(args.socket, args.show_all)
+        if text is not None:
+            print(text, end="")
+            return
+
+    cfg = load_config(args.config)
+    if cfg is None:
+        if args.config != CONFIG_PATH:
+            parser.error("Couldn't read {}".format(args.config))
+        cfg = default_config()
 
-    #
-    mailroot = '/home/earl/.mutt/offlineimap'
-    mailaccounts = ['dranek', 'mers', 'onion.avenger', 'rich.lindsley',
-            'richli.ff']
-
-    for acct in mailaccounts:
-        inbox = mailbox.Maildir(os.path.join(mailroot, acct, 'INBOX'),
-                create=False, factory=None)
-
-        # Find new messages, store some info about them
-        new_cnt = 0
-        new_text = {}
-        for msg in inbox.itervalues():
-            if 'S' not in msg.get_flags():
-                new_cnt += 1
-                #msg_text = ["{}".format(new_cnt)]
-                msg_text = []
-                if 'from' in msg:
-                    msg_text.append("  From: {}".format(msg['from']))
-                if 'subject' in msg:
-                    msg_text.append("  Subject: {}".format(msg['subject']))
-#                if 'date' in msg:
-#                    print("Date: {}".format(msg['date']))
-                msg_text.append("----")
-                new_text[new_cnt] = "\n".join(msg_text)
-
-        # Display totals, info from new messages
-        if args.show_all:
-            if new_cnt:
-                print("{}: {}/{}".format(acct, new_cnt, len(inbox)))
-                for msg in new_text.values():
-                    print(msg)
+    pool = concurrent.futures.ThreadPoolExecutor(max(1, args.jobs))
+    if args.daemon:
+        with pool:
+            daemon(lambda: config_folders(cfg, pool), args.show_all,
+                    args.socket, args.snapshot)
+        return
+
+    folders = config_folders(cfg, pool)
+    with pool:
+        jobs = []
+        for acct, folder, path in folders:
+            db_path = None if args.no_cache else os.path.join(args.cache_dir,
+                    acct, folder + '.sqlite')
+            jobs.append((acct, folder, pool.submit(scan_folder, path, db_path)))
+
+        # Display totals, info from new messages, in the config's order
+        results = []
+        for acct, folder, job in jobs:
+            try:
+                total, unseen = job.result()
+            except OSError as e:
+                print("{}: can't scan {}: {}".format(folder_label(acct, folder),
+                    e.filename, e.strerror), file=sys.stderr)
+                continue
+            if args.json:
+                results.append({'account': acct, 'folder': folder,
+                    'total': total, 'unseen': len(unseen),
+                    'messages': [msg for msg in unseen if msg is not None]})
             else:
-                print("{}: {}".format(acct, len(inbox)))
-        else:
-            if new_cnt:
-                print("{} new mail on {}".format(new_cnt, acct))
-                for msg in new_text.values():
-                    print(msg)
+                print(report(folder_label(acct, folder), total, len(unseen),
+                    unseen, args.show_all), end="")
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,41 @@
 #!/usr/bin/env python
 __author__ = 'Rich Li'
-__version__ = 2.4
+__version__ = 3.9
 
 """ Monitors mail folders for changes using IDLE and then runs offlineimap
 
 The mail configuration (login details, folders) are specified with an ini-style
-config.
+config (idle_mail.ini, or --config). Besides user, pass, server and folders,
+an account can have a port (default 993) and a cafile to trust instead of the
+system's CAs (e.g. a self-signed test server, see sync_mail_on_idle_bench.py).
 
-This only runs on Python 3, not Python 2 (tested on Python 3.3)
+IDLE only watches the selected folder, so normally there's one IMAP session per
+folder. If the server supports NOTIFY (RFC 5465), one session per account
+watches all its folders instead (set "notify = no" for an account to avoid
+that).
 
-TODO
-----
+Syncing runs offlineimap, unless an account has a "maildir" option: then
+it's synced with a built-in fetcher instead (see maildir_fetcher), which
+keeps its own IMAP session open and only downloads what changed, using
+CONDSTORE/QRESYNC.
 
-* If a thread gets a network error or otherwise dies, I need to restart it
-* Sometimes I'll get a socket error (seems to be on gmail usually) in a thread
-but no output from it until I kill it. But in the meantime, CPU usage shoots to
-100%.
+All the IMAP sessions are multiplexed on one asyncio event loop, so this needs
+Python 3.7 or newer. If a session gets a network error or the server kicks it
+out, it's reconnected (backing off exponentially while that keeps failing)
+and its folders are synced to catch up on what it missed.
+
+All the timing (renewing each IDLE before the server's 30 minute limit, the
+forced syncs every "timeout" minutes, the status report) runs on one timer
+wheel with the monotonic clock, so the sessions only wake up when there's
+something to do. The renewals of sessions on the same server are staggered,
+and timers due at about the same time fire together. A session whose
+folders stay quiet has its forced syncs spaced out, doubling each time up to
+8 times its timeout, and back to its timeout on the next change.
+
+With --metrics-port it serves counters and histograms (IDLE events, how long
+triggers wait for their sync, sync durations and results, reconnects, time
+since the last good sync) in the Prometheus text format on localhost. With
+--metrics-file it writes them to a json file every minute instead.
 
 """
 
@@ -25,248 +45,1362 @@ but no output from it until I kill it. But in the meantime, CPU usage shoots to
 # v2.2 2014-01-17: Fix bugs with timing out properly
 # v2.3 2014-01-17: Don't trigger the same account too many times too quickly
 # v2.4 2014-03-28: Per-account timeouts
+# v3.0 2026-10-18: One asyncio event loop instead of a thread per folder
+# v3.1 2026-10-18: Watch all of an account's folders with NOTIFY if possible
+# v3.2 2026-10-18: Sync accounts in parallel, re-sync instead of dropping triggers
+# v3.3 2026-10-18: Only sync the folders that changed, unless it's a timeout
+# v3.4 2026-10-18: Optional built-in CONDSTORE/QRESYNC sync into a Maildir
+# v3.5 2026-10-18: Reconnect dead sessions with backoff, then catch up
+# v3.6 2026-10-18: Incremental response parser, typed responses
+# v3.7 2026-10-18: Metrics, served to Prometheus or written to a json file
+# v3.8 2026-10-18: port/cafile options, --config and --offlineimap, for testing
+# v3.9 2026-10-18: One timer wheel for all sessions, adaptive forced syncs
 
 # all these are from stdlib
 import sys, os
 import argparse
+import asyncio
+import collections
 import configparser
-import threading
+import functools
+import json
+import heapq
 import logging
-import select
-import queue
+import math
+import random
+import re
+import signal
+import socket
+import ssl
+import tempfile
 import time
-import imaplib
-import subprocess
 
-class idle_checker(threading.Thread):
-    """ This checks an IMAP folder using IDLE 
+IMAP_SSL_PORT = 993
+OFFLINEIMAP = '/usr/bin/offlineimap'
+# Longest response line allowed (a SEARCH of a big folder is one line)
+RESPONSE_LIMIT = 16 * 1024 * 1024
+# How much to read from the server at once
+READ_SIZE = 64 * 1024
+# How long to wait for a connection or the end of an IDLE (in seconds), and
+# how long the built-in fetcher waits on a silent server
+RESPONSE_TIMEOUT = 60
+# The most a built-in sync may take (in seconds) before it's given up on
+FETCH_TIMEOUT = 30 * 60
+# Renew IDLE this often (servers may drop it after 30 minutes), minus up to
+# RENEWAL_STAGGER_STEPS steps of RENEWAL_STAGGER_STEP to spread the renewals
+# of sessions on the same server (in seconds)
+IDLE_RENEWAL = 28*60
+RENEWAL_STAGGER_STEP = 10
+RENEWAL_STAGGER_STEPS = 18
+# How close together timers are merged into one wakeup (in seconds)
+TIMER_RESOLUTION = 5
+# How often to report on the sessions (in seconds)
+STATUS_INTERVAL = 5*60
+# A quiet session's forced syncs are spaced out up to this many timeouts
+FORCED_SYNC_MAX_FACTOR = 8
+# Reconnection backoff: the first delay, the longest delay, and how long (in
+# seconds) a session has to stay up for the next failure to start over
+BACKOFF_START = 5
+BACKOFF_MAX = 15*60
+BACKOFF_RESET = 5*60
+# Upper bounds of the histogram buckets (in seconds)
+METRICS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+# How often to write --metrics-file (in seconds)
+METRICS_INTERVAL = 60
+# Where the built-in fetcher keeps its state by default
+DEFAULT_STATE_DIR = '~/.cache/sync_mail_on_idle'
+# How many message bodies the built-in fetcher asks for at once
+FETCH_BATCH = 100
+# IMAP system flags and their Maildir equivalents
+MAILDIR_FLAGS = {'\\SEEN': 'S', '\\ANSWERED': 'R', '\\FLAGGED': 'F',
+        '\\DELETED': 'T', '\\DRAFT': 'D'}
+
+class imap_error(Exception):
+    """ The IMAP server said something unexpected """
+
+class imap_response(collections.namedtuple('imap_response',
+        'tag number kind text literals')):
+    """ One response from the server, split into its parts
+
+    tag: '*' if untagged, '+' for a continuation, or the command's tag
+    number: the number before the kind (e.g. the message count of EXISTS or
+    the sequence number of FETCH/EXPUNGE), or None
+    kind: the response's first word in uppercase (OK, EXISTS, FETCH, STATUS,
+    ...), or '' for a continuation
+    text: the rest of the response, with "{size}" placeholders for literals
+    literals: the literals, as bytes
+
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return ' '.join(str(part) for part in self[:4] if part not in (None, ''))
+
+class response_parser(object):
+    """ Splits the data from the server into responses
+
+    Data is fed in as it arrives, in chunks of any size, and buffered in a
+    bytearray. Each byte is only searched for CRLF once, however many reads
+    a response takes to arrive, and a literal is copied out once when it's
+    complete. The consumed part of the buffer is dropped once per read, so a
+    burst of hundreds of responses in one read costs one compaction.
+
+    """
+
+    head_re = re.compile(rb'([^ ]+)(?: (\d+)(?= ))?(?: ([^ ]*))?(?: (.*))?$', re.S)
+    literal_re = re.compile(rb'\{(\d+)\+?\}$')
+
+    def __init__(self, limit=RESPONSE_LIMIT):
+        self.buffer = bytearray()
+        self.limit = limit
+        self.line_start = 0 # where the current line (or literal) starts
+        self.scan = 0 # where to look for the next CRLF
+        self.literal_end = None # where the literal being read ends
+        self.parts = [] # text of the response so far, split at the literals
+        self.literals = []
+
+    def feed(self, data):
+        # Drop what's been parsed already
+        if self.line_start:
+            del self.buffer[:self.line_start]
+            self.scan -= self.line_start
+            if self.literal_end is not None:
+                self.literal_end -= self.line_start
+            self.line_start = 0
+        self.buffer += data
+
+    def next(self):
+        """ Return the next complete response, or None if there isn't one """
+        buf = self.buffer
+        while True:
+            if self.literal_end is not None:
+                if len(buf) < self.literal_end:
+                    return None
+                self.literals.append(bytes(buf[self.line_start:self.literal_end]))
+                self.line_start = self.scan = self.literal_end
+                self.literal_end = None
+
+            eol = buf.find(b'\r\n', self.scan)
+            if eol < 0:
+                if len(buf) - self.line_start > self.limit:
+                    raise imap_error("Response line too long")
+                # The CR might be there already, without its LF
+                self.scan = max(self.line_start, len(buf) - 1)
+                return None
+            line = bytes(buf[self.line_start:eol])
+            self.parts.append(line)
+            self.line_start = self.scan = eol + 2
+            size = self.literal_re.search(line)
+            if not size:
+                break
+            self.literal_end = self.line_start + int(size.group(1))
+
+        response = self.parse(b''.join(self.parts), tuple(self.literals))
+        self.parts = []
+        self.literals = []
+        return response
+
+    @staticmethod
+    def parse(text, literals):
+        head = response_parser.head_re.match(text)
+        if not head:
+            # An empty line or garbage (e.g. from a proxy): drop the session
+            # rather than letting it die of an AttributeError
+            raise imap_error("Malformed response: {!r}".format(text[:80]))
+        tag, number, kind, rest = head.groups()
+        tag = tag.decode('ascii', 'replace')
+        if tag == '+':
+            # A continuation has free text, with no kind
+            rest = b' '.join(part for part in (number, kind, rest) if part)
+            number, kind = None, b''
+        return imap_response(tag, int(number) if number else None,
+                (kind or b'').decode('ascii', 'replace').upper(),
+                (rest or b'').decode('utf-8', 'replace'), literals)
+
+def imap_quote(s):
+    """ Quote a string for an IMAP command, unless it already is """
+    if s.startswith('"') and s.endswith('"'):
+        return s
+    return '"{}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
+
+def imap_unquote(s):
+    """ The inverse of imap_quote """
+    if s.startswith('"') and s.endswith('"'):
+        return re.sub(r'\\(.)', r'\1', s[1:-1])
+    return s
+
+def parse_status_mailbox(rest):
+    """ Return the mailbox name from a STATUS response's 'mailbox (...)' """
+    if rest.startswith('"'):
+        end = 1
+        while rest[end] != '"':
+            end += 2 if rest[end] == '\\' else 1
+        return imap_unquote(rest[:end + 1])
+    return rest.split(' ', 1)[0]
+
+@functools.lru_cache(maxsize=None)
+def tls_context(cafile=None):
+    """ The TLS settings for connecting, shared by all the sessions """
+    return ssl.create_default_context(cafile=cafile)
+
+def parse_uid_set(uid_set):
+    """ Expand a UID set like '1:3,7' into a list of UIDs """
+    uids = []
+    for part in uid_set.split(','):
+        first, _, last = part.partition(':')
+        last = last or first
+        first, last = sorted((int(first), int(last)))
+        uids.extend(range(first, last + 1))
+    return uids
+
+def format_uid_set(uids):
+    """ The inverse of parse_uid_set, with runs collapsed into ranges """
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(first) if first == last else '{}:{}'.format(first, last)
+            for first, last in ranges)
+
+def maildir_flags(imap_flags):
+    """ Convert an IMAP flag list like '\\Seen \\Flagged' to Maildir's 'FS' """
+    return ''.join(sorted(MAILDIR_FLAGS[flag] for flag in imap_flags.upper().split()
+        if flag in MAILDIR_FLAGS))
+
+class metrics_registry(object):
+    """ Counters, histograms and last-success times, keyed by labels
+
+    Everything is kept in memory and only formatted when asked for, as
+    Prometheus text or as a dict for json. There's one instance, metrics.
+
+    """
+
+    def __init__(self, prefix='sync_mail_'):
+        self.prefix = prefix
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [bucket counts, sum, count]
+        self.last_success = {} # account -> time.monotonic() of its last good sync
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def succeeded(self, acct):
+        self.last_success[acct] = time.monotonic()
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n')) for name, value in labels) + '}'
+
+    def prometheus(self):
+        """ The metrics in the Prometheus text exposition format """
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                lines.append('# TYPE {}{} {}'.format(self.prefix, name, kind))
+                typed.add(name)
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append('{}{}{} {}'.format(self.prefix, name, self.format_labels(labels), value))
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            for bound, bucket in zip(METRICS_BUCKETS + ('+Inf',), buckets + [count]):
+                lines.append('{}{}_bucket{} {}'.format(self.prefix, name,
+                    self.format_labels(labels + (('le', bound),)), bucket))
+            lines.append('{}{}_sum{} {}'.format(self.prefix, name, self.format_labels(labels), total))
+            lines.append('{}{}_count{} {}'.format(self.prefix, name, self.format_labels(labels), count))
+        now = time.monotonic()
+        for acct, when in sorted(self.last_success.items()):
+            declare('seconds_since_last_sync', 'gauge')
+            lines.append('{}seconds_since_last_sync{} {:0.1f}'.format(self.prefix,
+                self.format_labels((('account', acct),)), now - when))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        """ The metrics as a dict, for json """
+        now = time.monotonic()
+        return {
+            'time': time.time(),
+            'counters': [dict(labels, name=name, value=value)
+                for (name, labels), value in sorted(self.counters.items())],
+            'histograms': [dict(labels, name=name, sum=total, count=count,
+                buckets=dict(zip(map(str, METRICS_BUCKETS), buckets)))
+                for (name, labels), (buckets, total, count) in sorted(self.histograms.items())],
+            'seconds_since_last_sync': {acct: now - when
+                for acct, when in sorted(self.last_success.items())},
+        }
+
+metrics = metrics_registry()
+
+class timer_wheel(object):
+    """ One scheduler for all the sessions' timers
+
+    Timers are put in slots TIMER_RESOLUTION seconds wide (rounding up), and
+    only the earliest slot has a callback on the event loop, so all the
+    timers in a slot fire in one wakeup. It uses the event loop's clock,
+    which is monotonic. There's one instance, timers.
+
+    """
+
+    def __init__(self, resolution=TIMER_RESOLUTION):
+        self.resolution = resolution
+        self.slots = {} # slot number -> timers, each a [callback, args]
+        self.heap = [] # the slot numbers in self.slots
+        self.handle = None # the event loop's callback for the earliest slot
+        self.staggers = {} # key -> how many offsets stagger() gave out
+
+    def call_later(self, delay, callback, *args):
+        """ Call callback(*args) in delay seconds (or a bit more)
+
+        Returns the timer, for cancel().
+
+        """
+        loop = asyncio.get_event_loop()
+        slot = math.ceil((loop.time() + delay) / self.resolution)
+        timer = [callback, args]
+        if slot not in self.slots:
+            self.slots[slot] = []
+            heapq.heappush(self.heap, slot)
+            if self.heap[0] == slot:
+                self.arm(loop)
+        self.slots[slot].append(timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        if timer is not None:
+            timer[0] = None
+
+    def stagger(self, key):
+        """ An offset to subtract from a delay, different for each call with key """
+        count = self.staggers.get(key, 0)
+        self.staggers[key] = count + 1
+        return (count % RENEWAL_STAGGER_STEPS) * RENEWAL_STAGGER_STEP
+
+    def arm(self, loop):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = loop.call_at(self.heap[0] * self.resolution, self.fire)
+
+    def fire(self):
+        loop = asyncio.get_event_loop()
+        self.handle = None
+        while self.heap and self.heap[0] * self.resolution <= loop.time():
+            for callback, args in self.slots.pop(heapq.heappop(self.heap)):
+                if callback is None:
+                    continue
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.exception("Timer {} failed".format(callback))
+        if self.heap:
+            self.arm(loop)
+
+timers = timer_wheel()
+
+class imap_session(object):
+    """ An IMAP session over TLS
+
+    Just the protocol basics (tagged commands and responses, parsed by a
+    response_parser), which the sessions below build on.
+
+    """
+
+    def __init__(self, name, mail_user, mail_pass, mail_server,
+            mail_port=IMAP_SSL_PORT, cafile=None):
+        self.name = name
+        self.mail_user = mail_user
+        self.mail_pass = mail_pass
+        self.mail_server = mail_server
+        self.mail_port = mail_port
+        self.cafile = cafile
+        self.capabilities = set()
+
+        self.reader = None
+        self.writer = None
+        self.parser = None
+        self.tag_num = 0
+        self.read_timeout = None # seconds of silence before giving up, if any
+
+    async def read_response(self):
+        """ Read one response (an imap_response)
+
+        This is safe to cancel: nothing that's been read is lost.
+
+        """
+        while True:
+            response = self.parser.next()
+            if response is not None:
+                return response
+            if self.read_timeout is None:
+                data = await self.reader.read(READ_SIZE)
+            else:
+                data = await asyncio.wait_for(self.reader.read(READ_SIZE),
+                        self.read_timeout)
+            if not data:
+                raise ConnectionError("{}: Server closed the connection".format(self.name))
+            self.parser.feed(data)
+
+    async def send(self, line):
+        self.writer.write((line + '\r\n').encode())
+        await self.writer.drain()
+
+    async def command(self, *args):
+        """ Send a command and wait for its tagged response
+
+        Returns the untagged responses that came before it. Raises imap_error
+        if the command didn't succeed.
+
+        """
+        self.tag_num += 1
+        tag = 'a{}'.format(self.tag_num)
+        await self.send('{} {}'.format(tag, ' '.join(args)))
+        untagged = []
+        while True:
+            response = await self.read_response()
+            if response.tag == tag:
+                if response.kind != 'OK':
+                    raise imap_error("{}: {} failed: {}".format(self.name, args[0], response))
+                return untagged
+            untagged.append(response)
+
+    async def login(self):
+        """ Connect and log in """
+        self.reader, self.writer = await asyncio.open_connection(
+                self.mail_server, self.mail_port, ssl=tls_context(self.cafile))
+        self.parser = response_parser()
+        # Notice dead connections even while idling for half an hour
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        greeting = await self.read_response()
+        if greeting.kind == "BYE":
+            raise imap_error("{}: Server refused the connection ({})".format(self.name, greeting))
+        if greeting.kind != "PREAUTH":
+            await self.command("LOGIN", imap_quote(self.mail_user), imap_quote(self.mail_pass))
+
+    async def capability(self):
+        """ Ask for the server's capabilities """
+        for response in await self.command("CAPABILITY"):
+            if response.kind == "CAPABILITY":
+                self.capabilities.update(response.text.upper().split())
+
+    def close(self):
+        """ Drop the connection, without logging out """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class idle_checker(imap_session):
+    """ This checks an IMAP folder using IDLE
+
+    As many instances of this class (coroutines on the shared event loop)
+    need to be created as IMAP folders to be checked. Each one holds a single
+    TLS stream and a few timestamps.
+
+    If it's given several folders and the server supports NOTIFY, one
+    instance watches all of them: NOTIFY SET asks the server for STATUS
+    responses about those folders while the session idles without any folder
+    selected.
 
-    As many instances of this class (threads) need to be created as IMAP
-    folders to be checked
-    
     """
 
     def __init__(self, mail_queue, mail_acct, mail_user, mail_pass,
-            mail_server, mail_folder, stop_signal, name, timeout=None):
-        """ Initializes the thread
+            mail_server, mail_folders, timeout=None, use_notify=True,
+            mail_port=IMAP_SSL_PORT, cafile=None):
+        """ Initializes the session (without connecting yet)
 
-        mail_queue: a queue object to use when an account is triggered
+        mail_queue: an asyncio queue to put (account, folder, time.monotonic())
+        on when a folder changes (folder is None to sync the whole account)
         mail_acct: the offlineimap account name
-        mail_user: IMAP username 
+        mail_user: IMAP username
         mail_pass: IMAP password
         mail_server: IMAP hostname (SSL is assumed yes)
-        mail_folder: IMAP foldername
+        mail_folders: list of IMAP foldernames. Without NOTIFY, only the
+        first is watched and connect() hands back the rest.
         timeout: max time (in seconds) until it syncs anyway. If None, then
         forever (so only syncs on IDLE)
+        use_notify: whether to use NOTIFY if the server supports it
+        mail_port: IMAP port
+        cafile: CA certificates to trust, instead of the system's
 
         """
-        super(idle_checker, self).__init__()
-
+        super().__init__('{}_{}'.format(mail_acct, mail_folders[0]),
+                mail_user, mail_pass, mail_server, mail_port, cafile)
         self.mail_queue = mail_queue
         self.mail_acct = mail_acct
-        self.mail_user = mail_user
-        self.mail_pass = mail_pass
-        self.mail_server = mail_server
-        self.mail_folder = mail_folder
-        self.stop_signal = stop_signal
-        self.name = name
+        self.mail_folders = list(mail_folders)
+        self.mail_folder = self.mail_folders[0]
+        self.use_notify = use_notify and len(self.mail_folders) > 1
+        self.notify = False # whether NOTIFY is in use
         self.timeout = timeout
 
-        # Connect
-        self.server = imaplib.IMAP4_SSL(mail_server)
+        self.idle_tag = None
+        self.kicked_out = False # whether the server said BYE
+        self.renewing = False # whether DONE was sent to renew the IDLE
 
-        self.last_sync = time.time()
-        self.last_print = time.time()
+        # All times are time.monotonic()
+        self.last_sync = time.monotonic()
         self.last_idle = None
-        self.running = True # whether we're currently running ok
-        self.stop_it = False # whether it's time to stop and clean up
+        self.sync_factor = 1 # how many timeouts until the next forced sync
+        self.renew_timer = self.done_timer = self.sync_timer = None
         logging.info("Spawned {}".format(self.name))
 
-    def stop(self):
-        self.stop_it = True
+    async def connect(self, spawn):
+        """ Connect, log in and select the folder (or set up NOTIFY)
+
+        As soon as NOTIFY is ruled out, the folders this session won't watch
+        are handed to spawn (with this session) to get sessions of their own.
+        That's before the SELECT, so they're watched even if this session's
+        folder can't be selected.
+
+        """
+        self.name = '{}_{}'.format(self.mail_acct, self.mail_folder)
+        self.notify = False
+        self.kicked_out = False
+        self.last_idle = None
+        if not self.use_notify:
+            self.hand_back(spawn)
+        await self.login()
+
+        if self.use_notify:
+            await self.capability()
+            if "NOTIFY" in self.capabilities and await self.set_notify():
+                logging.debug("{}: Connected, using NOTIFY".format(self.name))
+                return
+            self.hand_back(spawn)
+
+        await self.command("SELECT", imap_quote(self.mail_folder))
+        logging.debug("{}: Connected".format(self.name))
+
+    def hand_back(self, spawn):
+        """ Only watch the first folder from now on, spawn the others """
+        leftover = self.mail_folders[1:]
+        self.mail_folders = self.mail_folders[:1]
+        self.use_notify = False
+        if leftover:
+            spawn(self, leftover)
+
+    async def set_notify(self):
+        """ Ask for notifications about all the folders, returns success """
+        mailboxes = " ".join(imap_quote(folder) for folder in self.mail_folders)
+        for events in ("MessageNew MessageExpunge FlagChange",
+                "MessageNew MessageExpunge"):
+            try:
+                await self.command("NOTIFY", "SET", "(mailboxes ({}) ({}))".format(
+                    mailboxes, events))
+            except imap_error as e:
+                logging.debug("{}: NOTIFY SET refused ({})".format(self.name, e))
+                continue
+            self.notify = True
+            self.name = self.mail_acct
+            return True
+        logging.info("{}: NOTIFY didn't work, falling back to IDLE".format(self.name))
+        return False
+
+    async def start_idle(self):
+        logging.debug("{}: Sent IDLE command".format(self.name))
+        self.tag_num += 1
+        self.idle_tag = 'a{}'.format(self.tag_num)
+        await self.send("{} IDLE".format(self.idle_tag))
+        self.last_idle = time.monotonic()
+        self.renewing = False
+        timers.cancel(self.renew_timer)
+        self.renew_timer = timers.call_later(IDLE_RENEWAL - timers.stagger(self.mail_server),
+                self.renew_idle)
+
+        # Expect initial response
+        while True:
+            resp = await self.read_response()
+            if resp.tag == "+":
+                break
+            if not self.handle(resp):
+                raise imap_error("{}: Unexpected response: {}".format(self.name, resp))
+
+    async def finish_idle(self):
+        logging.debug("{}: Finishing IDLE command".format(self.name))
+        if not self.renewing:
+            await self.send("DONE")
+        self.last_idle = None
+        # The response is probably something like "OK IDLE terminated"
+        # but why bother checking it
+        while True:
+            resp = await self.read_response()
+            if resp.tag == self.idle_tag:
+                break
+            self.handle(resp)
+
+    def trigger(self, folder=None):
+        """ Ask for a sync of a folder, or of the whole account if None """
+        self.mail_queue.put_nowait((self.mail_acct, folder, time.monotonic()))
+        self.last_sync = time.monotonic()
+        if folder is not None and self.sync_factor != 1:
+            # Something changed, so go back to the normal forced syncs; the
+            # timer may be set for up to FORCED_SYNC_MAX_FACTOR timeouts
+            self.sync_factor = 1
+            self.schedule_sync()
+
+    def renew_idle(self):
+        """ Timer: end the IDLE, so the loop starts a new one """
+        if not self.last_idle or self.writer is None:
+            return
+        logging.debug("{}: Renewing IDLE".format(self.name))
+        self.writer.write(b"DONE\r\n")
+        self.renewing = True
+        self.done_timer = timers.call_later(RESPONSE_TIMEOUT, self.abort,
+                "IDLE didn't end")
 
-    def run(self):
-        server = self.server
-        server.login(self.mail_user, self.mail_pass)
-        select_info = server.select(self.mail_folder)
+    def abort(self, reason):
+        """ Timer: give up on a connection that stopped answering """
+        if self.writer is not None:
+            logging.error("{}: {}, dropping the connection".format(self.name, reason))
+            self.writer.transport.abort()
 
+    def schedule_sync(self):
+        timers.cancel(self.sync_timer)
+        self.sync_timer = None
+        if self.timeout:
+            self.sync_timer = timers.call_later(self.timeout * self.sync_factor,
+                    self.forced_sync)
+
+    def forced_sync(self):
+        """ Timer: sync anyway if it's been long enough """
+        now = time.monotonic()
+        due = self.last_sync + self.timeout * self.sync_factor
+        if now + TIMER_RESOLUTION < due:
+            # There's been a sync since, wait for the rest
+            self.sync_timer = timers.call_later(due - now, self.forced_sync)
+            return
+        logging.info("{}: Triggering due to timeout exceeded ({:0.1f} minutes)".format(self.name, (now - self.last_sync) / 60))
+        self.trigger()
+        self.sync_factor = min(2 * self.sync_factor, FORCED_SYNC_MAX_FACTOR)
+        self.schedule_sync()
+
+    def status(self):
+        """ A line about how the session's doing """
+        now = time.monotonic()
+        msg = "{}: idling".format(self.name) if self.last_idle else "{}: not idling".format(self.name)
+        if self.timeout:
+            msg += ", {:0.1f} min since last sync".format((now - self.last_sync)/60)
+            msg += ", at most {:0.1f} min until next sync".format(
+                (self.timeout * self.sync_factor - now + self.last_sync)/60)
+        return msg
+
+    def close(self):
+        for timer in (self.renew_timer, self.done_timer, self.sync_timer):
+            timers.cancel(timer)
+        self.renew_timer = self.done_timer = self.sync_timer = None
+        super().close()
+
+    def handle(self, resp):
+        """ Handle a response while idling, returns False to stop the session """
+        kind = resp.kind
+        if resp.tag == "*":
+            if kind == "STATUS":
+                folder = parse_status_mailbox(resp.text)
+            else:
+                folder = "" if self.notify else self.mail_folder
+            metrics.count('idle_events_total', account=self.mail_acct, folder=folder, kind=kind)
+        if resp.tag == self.idle_tag:
+            # The IDLE ended (by renew_idle, or by the server itself), start
+            # another one
+            if self.renewing:
+                logging.debug("{}: IDLE ended ({})".format(self.name, resp))
+                timers.cancel(self.done_timer)
+                self.renewing = False
+            else:
+                logging.warning("{}: IDLE ended ({})".format(self.name, resp))
+            self.last_idle = None
+        elif resp.tag != "*":
+            logging.warning("{}: ignoring unexpected response ({})".format(self.name, resp))
+        elif kind == "OK" and "[NOTIFICATIONOVERFLOW]" in resp.text:
+            # NOTIFY gave up on telling what changed, sync everything
+            logging.info("{}: too many changes ({})".format(self.name, resp))
+            self.trigger()
+        elif kind == "OK":
+            # The IMAP server is just saying OK once in a while,
+            # nothing's wrong
+            # (dovecot seems especially noisy in doing this every few
+            # minutes)
+            logging.debug("{}: everything is okay ({})".format(self.name, resp))
+        elif kind == "STATUS":
+            # status: NOTIFY says something changed in a folder
+            logging.info("{}: {} changed ({})".format(self.name, folder, resp))
+            self.trigger(folder)
+        elif kind == "EXISTS":
+            # exists: number of messages in mailbox
+            logging.info("{}: new mail detected, {} messages ({})".format(self.name, resp.number, resp))
+            self.trigger(self.mail_folder)
+        elif kind == "RECENT":
+            # recent: new mail, this session is the first to see it
+            # for mail checking purposes, this is redundant since a
+            # new mail will trigger both "recent" and "exists"
+            # (dovecot does this) or "exists" only (gmail doesn't
+            # support recent)
+            logging.debug("{}: new mail detected, but ignoring this response ({})".format(self.name, resp))
+        elif kind == "FETCH":
+            # fetch: something about the message changed (flags, etc)
+            logging.info("{}: mail {} changed ({})".format(self.name, resp.number, resp))
+            self.trigger(self.mail_folder)
+        elif kind in ("EXPUNGE", "VANISHED"):
+            # expunge: message deleted (expunged) from mailbox
+            logging.info("{}: mail deleted ({})".format(self.name, resp))
+            self.trigger(self.mail_folder)
+        elif kind == "BYE":
+            logging.warning("{}: Server kicked me out ({})".format(self.name, resp))
+            self.kicked_out = True
+            return False
+        else:
+            # Anything else (e.g. FLAGS, or a NO warning) doesn't mean the
+            # mail changed
+            logging.warning("{}: ignoring a response I don't know ({})".format(self.name, resp))
+        return True
+
+    async def supervise(self, spawn):
+        """ Connect and IDLE until cancelled, reconnecting whenever needed
+
+        spawn is called with this session and the folders connect() hands
+        back, to watch those with sessions of their own. That happens at most
+        once: from then on, this session only watches its first folder.
+
+        """
+        failures = 0
+        connected_at = None
         while True:
-            # Display status periodically
-            now = time.time()
-            if (now - self.last_print) >= 5*60 :
-                msg = "{}: idling at {}".format(self.name, time.strftime("%d %b %I:%M:%S"))
-                if self.timeout:
-                    msg += ", {:0.1f} min since last sync".format((now - self.last_sync)/60)
-                    msg += ", at most {:0.1f} min until next sync".format((self.timeout - now + self.last_sync)/60)
-                logging.info(msg)
-                self.last_print = now
+            if failures:
+                delay = min(BACKOFF_MAX, BACKOFF_START * 2**(failures - 1))
+                delay *= random.uniform(0.5, 1)
+                logging.info("{}: Reconnecting in {:0.0f} s".format(self.name, delay))
+                await asyncio.sleep(delay)
+
+            try:
+                await asyncio.wait_for(self.connect(spawn), RESPONSE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, imap_error) as e:
+                logging.error("{}: Couldn't connect ({})".format(self.name, e))
+                metrics.count('connect_failures_total', account=self.mail_acct)
+                self.close()
+                failures += 1
+                continue
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            if connected_at is not None:
+                # Catch up on whatever changed while disconnected
+                metrics.count('reconnects_total', account=self.mail_acct)
+                for folder in self.mail_folders:
+                    self.trigger(folder)
+            connected_at = time.monotonic()
+
+            try:
+                await self.run()
+            except (OSError, asyncio.TimeoutError, imap_error) as e:
+                logging.error("{}: Session died ({})".format(self.name, e))
+                metrics.count('session_errors_total', account=self.mail_acct)
+            self.close()
+            if time.monotonic() - connected_at > BACKOFF_RESET:
+                failures = 0
+            failures += 1
+
+    async def run(self):
+        try:
+            await self.idle_loop()
+        except asyncio.CancelledError:
+            logging.info("{}: Terminating session".format(self.name))
+            try:
+                await asyncio.wait_for(self.logout(), 10)
+            except (OSError, asyncio.TimeoutError, imap_error) as e:
+                logging.debug("{}: Couldn't log out cleanly ({})".format(self.name, e))
+            self.close()
+            raise
+        await self.logout()
 
+    async def idle_loop(self):
+        # The timers do everything but reading the responses
+        self.schedule_sync()
+        while True:
             if not self.last_idle:
                 # Start IDLE if we haven't already
-                logging.debug("{}: Sent IDLE command".format(self.name))
-                server.send("a IDLE\r\n".encode())
-                self.last_idle = time.time()
-
-                # Expect initial response
-                resp = server.readline().decode()
-                if not resp.startswith("+"):
-                    raise Exception("{}: Unexpected response: {}".format(self.name, resp))
-
-            # Wait for further response
-            # (the smaller of time left until sync timeout, time remaining in current idle
-            # command, and time left until next status print)
-            now = time.time()
-            until_print = now - self.last_print
-            until_sync = now - self.last_sync
-            until_idle = now - self.last_idle
-            waittime = min(self.timeout - until_sync, 28*60 - until_idle, 5*60 - until_print)
-            logging.debug("{}: time since issued IDLE is {:0.1f} minutes, since last sync is {:0.1f} minutes".format(self.name, until_idle/60, until_sync/60))
-            if waittime < 0:
-                logging.warning("{}: waittime is < 0, time since last idle is {:0.1f} seconds".format(self.name, now - self.last_idle))
-                waittime = 10
-            logging.debug("{}: Idling, waiting for {:0.1f} min".format(self.name, waittime/60))
-            readlist, _, _ = select.select([server.socket(), self.stop_signal], [], [], waittime)
+                await self.start_idle()
 
-            # Check if we need to exit
-            if self.stop_it:
-                logging.info("{}: Terminating thread".format(self.name))
+            if not self.handle(await self.read_response()):
                 break
 
-            # Check IDLE response
-            for sock in readlist:
-                sock_msg_raw = sock.read().decode().strip()
-                for sock_msg in sock_msg_raw.splitlines():
-                    if sock_msg.startswith("* OK"):
-                        # The IMAP server is just saying OK once in a while,
-                        # nothing's wrong
-                        # (dovecot seems especially noisy in doing this every few
-                        # minutes)
-                        logging.debug("{}: everything is okay ({})".format(self.name, sock_msg))
-                    elif "EXISTS" in sock_msg.split():
-                        # exists: number of messages in mailbox
-                        logging.info("{}: new mail detected ({})".format(self.name, sock_msg))
-                        self.mail_queue.put(self.mail_acct)
-                        self.last_sync = self.last_print = time.time()
-                    elif "RECENT" in sock_msg.split():
-                        # recent: new mail, this session is the first to see it
-                        # for mail checking purposes, this is redundant since a
-                        # new mail will trigger both "recent" and "exists"
-                        # (dovecot does this) or "exists" only (gmail doesn't
-                        # support recent)
-                        logging.debug("{}: new mail detected, but ignoring this response ({})".format(self.name, sock_msg))
-                    elif "FETCH" in sock_msg.split():
-                        # fetch: something about the message changed (flags, etc)
-                        logging.info("{}: mail status changed ({})".format(self.name, sock_msg))
-                        self.mail_queue.put(self.mail_acct)
-                        self.last_sync = self.last_print = time.time()
-                    elif "EXPUNGE" in sock_msg.split():
-                        # expunge: message deleted (expunged) from mailbox
-                        logging.info("{}: mail deleted ({})".format(self.name, sock_msg))
-                        self.mail_queue.put(self.mail_acct)
-                        self.last_sync = self.last_print = time.time()
-                    elif sock_msg.startswith("* BYE"):
-                        logging.warning("{}: Server kicked me out ({})".format(self.name, sock_msg))
-                        self.stop_it = True
-                        break
-                    else:
-                        logging.error("{}: I don't know how to handle this ({})".format(self.name, sock_msg))
-                        self.stop_it = True
-                        break
-
-            # Finish IDLE if it's been long enough (28 minutes)
-            if time.time() - self.last_idle >= 28*60:
-                logging.debug("{}: Finishing IDLE command".format(self.name))
-                server.send("DONE\r\n".encode())
-                self.last_idle = None
-                resp = server.readline().decode()
-                # The response is probably something like "OK IDLE terminated"
-                # but why bother checking it
-
-            # Sync anyway if it's been long enough
-            now = time.time()
-            if (now - self.last_sync) > self.timeout:
-                logging.info("{}: Triggering due to timeout exceeded ({:0.1f} minutes)".format(self.name, (now - self.last_sync) / 60))
-                self.mail_queue.put(self.mail_acct)
-                self.last_sync = self.last_print = now
-
-        # We're out of the while-True loop
+    async def logout(self):
+        if self.kicked_out:
+            self.writer.close()
+            logging.info("{}: Finished".format(self.name))
+            return
+
         # Get out of IDLE
         if self.last_idle:
-            logging.debug("{}: Finishing IDLE command".format(self.name))
-            server.send("DONE\r\n".encode())
-            self.last_idle = None
-            msg = server.readline()
+            await self.finish_idle()
 
-        logging.debug("{}: Closing mailbox".format(self.name))
-        server.close()
+        if not self.notify:
+            logging.debug("{}: Closing mailbox".format(self.name))
+            await self.command("CLOSE")
         logging.debug("{}: Logging out".format(self.name))
-        server.logout()
+        await self.command("LOGOUT")
+        self.writer.close()
         logging.info("{}: Finished".format(self.name))
 
-class idle_actor(threading.Thread):
-    """ This triggers offlineimap 
-    
-    Only one instance of this class (thread) is needed
-    
+class maildir_fetcher(imap_session):
+    """ This syncs an account's folders into a Maildir, without offlineimap
+
+    One instance per account keeps an IMAP session open between syncs, so a
+    sync is a few round trips instead of a new offlineimap process logging
+    in and listing folders. CONDSTORE (RFC 7162) tells it what changed since
+    the last sync: the folder's HIGHESTMODSEQ is compared on SELECT, then
+    only the changed UIDs are fetched with CHANGEDSINCE. With QRESYNC the
+    server also lists the expunged UIDs (VANISHED), otherwise they're found
+    with UID SEARCH.
+
+    It's a one-way mirror: local changes (flags, deletions) are not uploaded,
+    and it shouldn't share a Maildir with offlineimap. Each folder goes into
+    the Maildir under its IMAP name, with "/" replaced by "." like
+    offlineimap does. The UIDVALIDITY, HIGHESTMODSEQ and the UID -> file
+    mapping of every folder are kept in a json state file.
+
     """
 
-    def __init__(self, idle_queue, name):
-        super(idle_actor, self).__init__()
+    def __init__(self, mail_acct, mail_user, mail_pass, mail_server,
+            mail_folders, maildir, state_file, mail_port=IMAP_SSL_PORT, cafile=None):
+        """ Initializes the fetcher (without connecting yet)
+
+        mail_acct: the account name
+        mail_user: IMAP username
+        mail_pass: IMAP password
+        mail_server: IMAP hostname (SSL is assumed yes)
+        mail_folders: list of IMAP foldernames to sync on a full sync
+        maildir: the root of the account's local Maildir folders
+        state_file: json file with what's already been fetched
+        mail_port: IMAP port
+        cafile: CA certificates to trust, instead of the system's
+
+        """
+        super().__init__('{}_fetch'.format(mail_acct), mail_user, mail_pass,
+                mail_server, mail_port, cafile)
+        self.mail_acct = mail_acct
+        self.mail_folders = list(mail_folders)
+        self.maildir = maildir
+        self.state_file = state_file
+        self.qresync = False
+        self.supported = True # False once the server turns out not to do CONDSTORE
+        self.deliveries = 0
+        # Unlike an IDLE, a sync never has to wait long for the server
+        self.read_timeout = RESPONSE_TIMEOUT
+
+        try:
+            with open(state_file) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+        logging.info("Spawned {}".format(self.name))
+
+    async def connect(self):
+        """ Log in and enable QRESYNC if possible """
+        await self.login()
+        await self.capability()
+        if "QRESYNC" in self.capabilities:
+            await self.command("ENABLE", "QRESYNC")
+            self.qresync = True
+        elif "CONDSTORE" not in self.capabilities:
+            self.close()
+            self.supported = False
+            raise imap_error("{}: The server doesn't support CONDSTORE".format(self.name))
+        logging.debug("{}: Connected{}".format(self.name,
+            ", using QRESYNC" if self.qresync else ""))
+
+    async def logout(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command("LOGOUT")
+        finally:
+            self.close()
+        logging.info("{}: Finished".format(self.name))
+
+    async def sync(self, folders=None):
+        """ Sync some folders, or all of them if None
+
+        If anything goes wrong (including being cancelled), the connection is
+        dropped, to reconnect on the next sync, and the error raised. Nothing
+        reads the session between syncs, so one kept from an earlier sync may
+        have died meanwhile (e.g. the server's autologout): then the sync is
+        retried once on a new connection first.
+
+        """
+        retry = self.writer is not None
+        while True:
+            try:
+                if self.writer is None:
+                    await self.connect()
+                for folder in sorted(folders or self.mail_folders):
+                    await self.sync_folder(folder)
+                return
+            except BaseException as e:
+                self.close()
+                if not (retry and self.supported and isinstance(e,
+                        (OSError, asyncio.TimeoutError, imap_error))):
+                    raise
+                retry = False
+                logging.info("{}: Reconnecting, the session died ({})".format(self.name, e))
+
+    async def sync_folder(self, folder):
+        untagged = await self.command("SELECT", imap_quote(folder), "(CONDSTORE)")
+        uidvalidity = highestmodseq = None
+        for response in untagged:
+            found = re.match(r'\[(UIDVALIDITY|HIGHESTMODSEQ) (\d+)\]', response.text)
+            if response.kind != "OK" or not found:
+                continue
+            if found.group(1) == "UIDVALIDITY":
+                uidvalidity = int(found.group(2))
+            else:
+                highestmodseq = int(found.group(2))
+        if highestmodseq is None:
+            raise imap_error("{}: {} has no MODSEQ".format(self.name, folder))
+
+        path = os.path.join(self.maildir, folder.replace('/', '.'))
+        state = self.state.get(folder)
+        if state and state['uidvalidity'] != uidvalidity:
+            logging.warning("{}: UIDVALIDITY of {} changed, fetching it again".format(self.name, folder))
+            for filename in state['messages'].values():
+                self.remove_message(path, filename)
+            state = None
+        if state and state['highestmodseq'] == highestmodseq:
+            logging.debug("{}: {} hasn't changed".format(self.name, folder))
+            return
+        messages = dict(state['messages']) if state else {}
+
+        # Ask for the flags of what's changed (everything, the first time)
+        vanished = set()
+        if not state:
+            changes = await self.command("UID FETCH 1:* (FLAGS)")
+        elif self.qresync:
+            changes = await self.command("UID FETCH 1:* (FLAGS) (CHANGEDSINCE {} VANISHED)".format(
+                state['highestmodseq']))
+        else:
+            changes = await self.command("UID FETCH 1:* (FLAGS) (CHANGEDSINCE {})".format(
+                state['highestmodseq']))
+            existing = set()
+            for response in await self.command("UID SEARCH ALL"):
+                if response.kind == "SEARCH":
+                    existing.update(response.text.split())
+            vanished = set(messages) - existing
+
+        new = []
+        changed = 0
+        for response in changes:
+            if response.kind == "VANISHED":
+                vanished.update(str(uid) for uid in parse_uid_set(response.text.split()[-1]))
+                continue
+            if response.kind != "FETCH":
+                continue
+            uid = re.search(r'\bUID (\d+)', response.text)
+            flags = re.search(r'\bFLAGS \(([^)]*)\)', response.text)
+            if not uid or not flags:
+                continue
+            uid = uid.group(1)
+            if uid in messages:
+                messages[uid] = self.set_message_flags(path, messages[uid],
+                        maildir_flags(flags.group(1)))
+                changed += 1
+            else:
+                new.append(int(uid))
+
+        for uid in vanished:
+            if uid in messages:
+                self.remove_message(path, messages.pop(uid))
+
+        # Download the new messages
+        for start in range(0, len(new), FETCH_BATCH):
+            batch = format_uid_set(new[start:start + FETCH_BATCH])
+            for response in await self.command("UID FETCH {} (FLAGS BODY.PEEK[])".format(batch)):
+                uid = re.search(r'\bUID (\d+)', response.text)
+                flags = re.search(r'\bFLAGS \(([^)]*)\)', response.text)
+                if response.kind != "FETCH" or not uid or not response.literals:
+                    continue
+                messages[uid.group(1)] = self.deliver(path, response.literals[-1],
+                        maildir_flags(flags.group(1) if flags else ''))
+
+        logging.info("{}: {}: {} new, {} changed, {} deleted".format(self.name, folder,
+            len(new), changed, len(vanished)))
+        self.state[folder] = {'uidvalidity': uidvalidity,
+                'highestmodseq': highestmodseq, 'messages': messages}
+        self.save_state()
+
+    def deliver(self, path, data, flags):
+        """ Add a message to a Maildir folder, returns its file name """
+        for subdir in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+        self.deliveries += 1
+        now = time.time()
+        name = '{:.0f}.M{:06d}P{}Q{}.{}'.format(now, int(now % 1 * 1e6), os.getpid(),
+                self.deliveries, socket.gethostname())
+        tmp_name = os.path.join(path, 'tmp', name)
+        with open(tmp_name, 'wb') as f:
+            f.write(data.replace(b'\r\n', b'\n'))
+        filename = os.path.join('cur' if 'S' in flags else 'new', name + ':2,' + flags)
+        os.rename(tmp_name, os.path.join(path, filename))
+        return filename
+
+    def find_message(self, path, filename):
+        """ Find a message, even if a mail reader renamed it """
+        if os.path.exists(os.path.join(path, filename)):
+            return filename
+        base = os.path.basename(filename).split(':', 1)[0]
+        for subdir in ('cur', 'new'):
+            try:
+                names = os.listdir(os.path.join(path, subdir))
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if name.split(':', 1)[0] == base:
+                    return os.path.join(subdir, name)
+        return None
+
+    def set_message_flags(self, path, filename, flags):
+        """ Change a message's flags, returns its new file name """
+        old = self.find_message(path, filename)
+        if old is None:
+            logging.warning("{}: {} disappeared".format(self.name, filename))
+            return filename
+        subdir, name = os.path.split(old)
+        new = os.path.join('cur' if 'S' in flags else subdir,
+                name.split(':', 1)[0] + ':2,' + flags)
+        if new != old:
+            os.rename(os.path.join(path, old), os.path.join(path, new))
+        return new
+
+    def remove_message(self, path, filename):
+        old = self.find_message(path, filename)
+        if old is not None:
+            os.remove(os.path.join(path, old))
+
+    def save_state(self):
+        """ Write the state file atomically """
+        directory = os.path.dirname(self.state_file)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            json.dump(self.state, f)
+        os.replace(f.name, self.state_file)
+
+class idle_actor(object):
+    """ This triggers offlineimap
+
+    Only one instance of this class (coroutine) is needed. It runs the syncs
+    of different accounts in parallel, up to max_syncs at a time, but never
+    two syncs of the same account at once. The folders that changed are
+    collected per account and synced together with one "offlineimap -f" run;
+    a trigger without a folder (a timeout) makes it a full sync of the
+    account. If an account is triggered while it's syncing, the new folders
+    are synced exactly once more afterwards, however many triggers came in
+    meanwhile.
+
+    Accounts with a maildir_fetcher in fetchers (account -> fetcher) are
+    synced with it instead of offlineimap, unless it fails.
+
+    """
+
+    def __init__(self, idle_queue, name, max_syncs=2, fetchers=None,
+            offlineimap=OFFLINEIMAP):
         self.idle_queue = idle_queue
-        self.stop_it = False
         self.name = name
-        # If the same account is triggered multiple times quickly (e.g.,
-        # multiple folders within the same account have updates), then this
-        # ignores subsequent triggers for a time period of remember_time (in
-        # seconds). last_sync is a dict that keeps track of the last time each
-        # account was synced.
-        self.remember_time = 20  # seconds
-        self.last_sync = {} 
+        self.offlineimap = offlineimap
+        self.fetchers = fetchers or {}
+        self.sync_slots = asyncio.Semaphore(max_syncs)
+        self.pending = {} # account -> task, from the trigger until it's synced
+        self.syncing = set() # accounts with offlineimap running right now
+        self.dirty = {} # account -> set of folders to sync next, None for all
+        self.triggered = {} # account -> time.monotonic() of its oldest unsynced trigger
         logging.info("Spawned {}".format(self.name))
 
     def stop(self):
-        self.stop_it = True
-        # Add a dummy item to the queue so it wakes up the thread
-        self.idle_queue.put("_stop")
+        # Add a dummy item to the queue so it wakes up
+        self.idle_queue.put_nowait(None)
+
+    def mark_dirty(self, acct, folder):
+        """ Add a folder (None for all of them) to the account's next sync """
+        if folder is None:
+            self.dirty[acct] = None
+        elif acct not in self.dirty:
+            self.dirty[acct] = {folder}
+        elif self.dirty[acct] is not None:
+            self.dirty[acct].add(folder)
 
-    def run(self):
+    async def run(self):
         while True:
-            acct = self.idle_queue.get()
+            item = await self.idle_queue.get()
             logging.debug("{}: got an item from the queue".format(self.name))
 
             # Check if we need to exit
-            if self.stop_it:
-                logging.info("{}: Terminating thread".format(self.name))
+            if item is None:
+                logging.info("{}: Terminating".format(self.name))
                 break
 
-            # Check if it's been long enough for this account to trigger
-            now = time.time()
-            acct_time = self.last_sync.get(acct, now - self.remember_time - 10)
-
-            if (now - acct_time) > self.remember_time:
-                # Run offlineimap for the accounts
-                logging.info("Syncing {} at {}".format(acct, time.strftime("%d %b %I:%M:%S")))
-                cmd = ["/usr/bin/offlineimap", "-o", "-a", acct, "-k", "mbnames:enabled=no"]
-                logging.debug("Calling {}".format(cmd))
-                # NB: offlineimap actually outputs to stderr, not stdout
-                cmd_out = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                #print(cmd_out)
-                self.last_sync[acct] = now
+            acct, folder, when = item
+            metrics.count('triggers_total', account=acct,
+                    folder="" if folder is None else folder)
+            self.mark_dirty(acct, folder)
+            self.triggered.setdefault(acct, when)
+            if acct not in self.pending:
+                self.pending[acct] = asyncio.ensure_future(self.sync_account(acct))
+            elif acct in self.syncing:
+                logging.debug("{}: {} is syncing, will sync it again afterwards".format(self.name, acct))
             else:
-                logging.debug("{}: won't trigger {} since it was {:0.1f} seconds from the last time it triggered".format(self.name, acct, now - acct_time))
+                logging.debug("{}: {} is already waiting to sync".format(self.name, acct))
+
+        # Let the syncs in progress finish
+        await asyncio.gather(*self.pending.values(), return_exceptions=True)
+
+    async def sync_account(self, acct):
+        """ Sync an account until it's no longer dirty """
+        try:
+            while True:
+                async with self.sync_slots:
+                    folders = self.dirty.pop(acct)
+                    metrics.observe('sync_queue_delay_seconds',
+                            time.monotonic() - self.triggered.pop(acct), account=acct)
+                    self.syncing.add(acct)
+                    try:
+                        await self.sync(acct, folders)
+                    finally:
+                        self.syncing.discard(acct)
+                if acct not in self.dirty:
+                    break
+                logging.info("{}: {} changed during its sync, syncing again".format(self.name, acct))
+        finally:
+            del self.pending[acct]
+
+    async def sync(self, acct, folders=None):
+        fetcher = self.fetchers.get(acct)
+        if fetcher is not None and fetcher.supported:
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(fetcher.sync(folders), FETCH_TIMEOUT)
+                status = "ok"
+            except (OSError, asyncio.TimeoutError, imap_error) as e:
+                logging.error("{}: built-in sync of {} failed, using offlineimap ({})".format(self.name, acct,
+                    str(e) or "timed out"))
+                status = "error"
+            metrics.observe('sync_duration_seconds', time.monotonic() - start,
+                    account=acct, backend="builtin")
+            metrics.count('syncs_total', account=acct, backend="builtin", status=status)
+            if status == "ok":
+                metrics.succeeded(acct)
+                return
+
+        # Run offlineimap for the account, only for some folders if given
+        cmd = [self.offlineimap, "-o", "-a", acct, "-k", "mbnames:enabled=no"]
+        if folders and not any("," in folder for folder in folders):
+            # offlineimap splits -f on commas, so those need a full sync
+            cmd += ["-f", ",".join(sorted(folders))]
+            logging.info("Syncing {} ({}) at {}".format(acct, ", ".join(sorted(folders)),
+                time.strftime("%d %b %I:%M:%S")))
+        else:
+            logging.info("Syncing {} at {}".format(acct, time.strftime("%d %b %I:%M:%S")))
+        logging.debug("Calling {}".format(cmd))
+        start = time.monotonic()
+        # NB: offlineimap actually outputs to stderr, not stdout
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        cmd_out, _ = await proc.communicate()
+        metrics.observe('sync_duration_seconds', time.monotonic() - start,
+                account=acct, backend="offlineimap")
+        metrics.count('syncs_total', account=acct, backend="offlineimap",
+                status=str(proc.returncode))
+        if proc.returncode:
+            logging.error("{}: offlineimap exited with {} for {}".format(self.name, proc.returncode, acct))
+        else:
+            metrics.succeeded(acct)
+        #print(cmd_out)
+
+def session_done(task, checker):
+    """ Complain about sessions that end on their own (which is a bug) """
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logging.error("{}: {}".format(checker.name, task.exception()))
+    print("HEY, LISTEN! {} is dead!".format(checker.name))
+
+async def serve_metrics(reader, writer):
+    """ Answer an HTTP request (whatever it is) with the metrics """
+    try:
+        # Skip the request, up to the blank line
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if not line.strip():
+                break
+        body = metrics.prometheus().encode()
+        writer.write(b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + "Content-Length: {}\r\n\r\n".format(len(body)).encode() + body)
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError) as e:
+        logging.debug("Couldn't serve the metrics ({})".format(e))
+    finally:
+        writer.close()
+
+def write_metrics(path):
+    """ Write the metrics to a json file atomically """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        json.dump(metrics.as_dict(), f, indent=1)
+    os.replace(f.name, path)
+
+async def write_metrics_periodically(path):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        try:
+            write_metrics(path)
+        except OSError as e:
+            logging.error("Couldn't write the metrics to {} ({})".format(path, e))
+
+async def watch(cfg, max_syncs=2, metrics_port=None, metrics_file=None,
+        offlineimap=OFFLINEIMAP):
+    """ Connect all the sessions, then IDLE until SIGINT/SIGTERM
+
+    The metrics are served on localhost's metrics_port and/or written to
+    metrics_file, if given. offlineimap is the command to sync with.
+
+    """
+    mail_queue = asyncio.Queue()
+
+    # Create the producer sessions, starting with one per account. Those
+    # that can't use NOTIFY hand back the folders they won't watch, and each
+    # of those gets its own session.
+    checkers = []
+    fetchers = {}
+    for acct in cfg.sections():
+        mail_user = cfg.get(acct, "user")
+        mail_pass = cfg.get(acct, "pass")
+        mail_server = cfg.get(acct, "server")
+        mail_folders = cfg.get(acct, "folders")
+        mail_timeout = cfg.get(acct, "timeout", fallback=10)
+        mail_timeout = 60 * int(mail_timeout) # convert minutes to seconds
+        use_notify = cfg.getboolean(acct, "notify", fallback=True)
+        mail_port = cfg.getint(acct, "port", fallback=IMAP_SSL_PORT)
+        cafile = cfg.get(acct, "cafile", fallback=None)
 
+        folders = [folder.strip() for folder in mail_folders.split(",")]
+        checkers.append(idle_checker(mail_queue, acct, mail_user,
+            mail_pass, mail_server, folders, mail_timeout, use_notify,
+            mail_port, cafile))
+
+        # Sync with the built-in fetcher if there's a Maildir for it
+        maildir = cfg.get(acct, "maildir", fallback=None)
+        if maildir:
+            state_dir = cfg.get(acct, "state", fallback=DEFAULT_STATE_DIR)
+            fetchers[acct] = maildir_fetcher(acct, mail_user, mail_pass,
+                    mail_server, folders, os.path.expanduser(maildir),
+                    os.path.join(os.path.expanduser(state_dir), acct + '.json'),
+                    mail_port, cafile)
+
+    # Create the consumer that watches the queue
+    trigger = idle_actor(mail_queue, "trigger", max_syncs, fetchers, offlineimap)
+    trigger_task = asyncio.ensure_future(trigger.run())
+
+    # Connect and log in to everything at once, so startup only takes as long
+    # as the slowest server. Each session is supervised, so it reconnects if
+    # it dies.
+    tasks = []
+    sessions = []
+    def supervise(checker):
+        sessions.append(checker)
+        task = asyncio.ensure_future(checker.supervise(spawn))
+        task.add_done_callback(lambda task: session_done(task, checker))
+        tasks.append(task)
+
+    def spawn(checker, folders):
+        for folder in folders:
+            supervise(idle_checker(mail_queue, checker.mail_acct,
+                checker.mail_user, checker.mail_pass, checker.mail_server,
+                [folder], checker.timeout, False, checker.mail_port,
+                checker.cafile))
+
+    for checker in checkers:
+        supervise(checker)
+
+    # Display status periodically
+    def report():
+        idling = sum(1 for checker in sessions if checker.last_idle)
+        logging.info("{} of {} sessions idling at {}".format(idling, len(sessions),
+            time.strftime("%d %b %I:%M:%S")))
+        for checker in sessions:
+            logging.debug(checker.status())
+        timers.call_later(STATUS_INTERVAL, report)
+    timers.call_later(STATUS_INTERVAL, report)
+
+    # Export the metrics
+    metrics_server = metrics_writer = None
+    if metrics_port:
+        metrics_server = await asyncio.start_server(serve_metrics, '127.0.0.1', metrics_port)
+        logging.info("Serving metrics on http://127.0.0.1:{}/metrics".format(metrics_port))
+    if metrics_file:
+        metrics_writer = asyncio.ensure_future(write_metrics_periodically(metrics_file))
+
+    # Watch for SIGINT and terminate gracefully
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_signal.set)
+    await stop_signal.wait()
+
+    logging.debug("Signaling stop to the sessions")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    trigger.stop()
+    await trigger_task
+    await asyncio.gather(*(asyncio.wait_for(fetcher.logout(), 10)
+        for fetcher in fetchers.values()), return_exceptions=True)
+
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    if metrics_writer is not None:
+        metrics_writer.cancel()
+        write_metrics(metrics_file)
 
 def main():
-    """ IDLE on certain IMAP folders 
+    """ IDLE on certain IMAP folders
 
     Each IDLE command is only for one folder, so I need to spawn several IMAP
-    sessions. Each session is in its own thread. Because the code is IO-bound
-    instead of CPU-bound the limitations of the GIL don't concern me here.
-    
+    sessions (unless the server does NOTIFY). The sessions all share one
+    asyncio event loop, since the code is IO-bound and spends nearly all its
+    time waiting on the network.
+
     """
     # Parse args
     parser = argparse.ArgumentParser(description="IDLE on certain IMAP folders")
-    parser.add_argument('--version', action='version', 
+    parser.add_argument('--config', '-c', action='store', default='idle_mail.ini',
+            help='the accounts config file (default: %(default)s)')
+    parser.add_argument('--offlineimap', action='store', default=OFFLINEIMAP,
+            help='the offlineimap to sync with (default: %(default)s)')
+    parser.add_argument('--max-syncs', action='store', type=int, default=2,
+            help='how many accounts to sync at once (default: %(default)s)')
+    parser.add_argument('--metrics-port', action='store', type=int,
+            help='serve Prometheus metrics on this port of localhost')
+    parser.add_argument('--metrics-file', action='store',
+            help='write the metrics to this json file every minute')
+    parser.add_argument('--version', action='version',
             version='%(prog)s version {}'.format(__version__))
     args = parser.parse_args()
 
@@ -280,51 +1414,11 @@ def main():
 
     # Read in account info
     cfg = configparser.ConfigParser()
-    cfg.read('idle_mail.ini')
-
-    # Create the consumer thread and its event it watches
-    mail_queue = queue.Queue()
-    trigger_thread = idle_actor(mail_queue, "trigger")
-    trigger_thread.start()
+    if not cfg.read(args.config):
+        parser.error("Couldn't read {}".format(args.config))
 
-    # Create a self pipe, it's used as a signal to the producer threads
-    pipe_signal = os.pipe2(os.O_NONBLOCK)
-
-    # Create the producer threads
-    idle_threads = []
-    for acct in cfg.sections():
-        mail_user = cfg.get(acct, "user")
-        mail_pass = cfg.get(acct, "pass")
-        mail_server = cfg.get(acct, "server")
-        mail_folders = cfg.get(acct, "folders")
-        mail_timeout = cfg.get(acct, "timeout", fallback=10)
-        mail_timeout = 60 * int(mail_timeout) # convert minutes to seconds
-
-        for folder_i, folder in enumerate(mail_folders.split(",")):
-            thread_name='{}_{}'.format(acct, folder.strip())
-            mail_idle = idle_checker(mail_queue, acct, mail_user, mail_pass,
-                    mail_server, folder.strip(), pipe_signal[0], thread_name,
-                    mail_timeout)
-            idle_threads.append(mail_idle)
-            mail_idle.start()
-
-    # Watch for SIGINT and terminate gracefully
-    try:
-        while True:
-            for thread in idle_threads:
-                if thread.is_alive:
-                    # The timeout value here doesn't matter so long as it's
-                    # not infinite (ie, no arg)
-                    thread.join(60) 
-                else:
-                    print("HEY, LISTEN! {} is dead!".format(thread.name))
-    except (KeyboardInterrupt, SystemExit):
-        logging.debug("Signaling stop_it to the threads")
-        trigger_thread.stop()
-        for t in idle_threads:
-            t.stop()
-        os.write(pipe_signal[1], "stop".encode())
-        #sys.exit()
+    asyncio.run(watch(cfg, args.max_syncs, args.metrics_port, args.metrics_file,
+        args.offlineimap))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""Load-test sync_mail_on_idle against a local fake IMAP server.
+
+The fake server speaks just enough IMAP over TLS (LOGIN, CAPABILITY, SELECT,
+NOTIFY, IDLE/DONE, CLOSE, LOGOUT) with a throwaway self-signed certificate
+made by openssl. It can push EXISTS/FETCH/EXPUNGE bursts (or STATUS, to
+NOTIFY sessions), say BYE, and drop connections.
+
+The watcher runs as a subprocess against --accounts x --folders simulated
+folders, with a stub instead of offlineimap that logs when it's started and
+for which folders. Reported:
+
+* notification to sync latency (a change is pushed to a random folder, the
+  stub says when it was started for it)
+* the same for a burst of FETCH/EXPUNGE responses
+* the watcher's CPU use while idle
+* its RSS, per watched folder
+* recovery time, from dropping (or BYE-ing) every connection until all the
+  folders are being watched again
+
+No real mail server is needed.
+
+"""
+__author__ = 'Rich Li'
+__version__ = 0.1
+
+# Version history:
+# v0.1 2026-10-18: Started
+
+import argparse
+import asyncio
+import math
+import os
+import random
+import re
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import sync_mail_on_idle
+
+# The stub that replaces offlineimap: logs the time and its arguments
+STUB = """#!/bin/bash
+echo "$EPOCHREALTIME $*" >> {log}
+"""
+
+
+def make_certificate(directory):
+    """Make a self-signed certificate for localhost, returns (cert, key)."""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                    '-days', '1', '-keyout', key, '-out', cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+class fake_session(object):
+    """One client connection to the fake server."""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.user = None
+        self.folder = None  # the selected folder
+        self.notify = set()  # the folders NOTIFY SET asked about
+        self.idle_tag = None
+
+    def write(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def run(self):
+        self.write(b'* OK fake IMAP ready\r\n')
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if not self.handle(line.decode().rstrip('\r\n')):
+                    break
+                await self.writer.drain()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.server.sessions.discard(self)
+            self.writer.close()
+
+    def handle(self, line):
+        """Answer a command, returns False after LOGOUT."""
+        if line.upper() == 'DONE' and self.idle_tag:
+            self.write('{} OK IDLE terminated\r\n'.format(self.idle_tag).encode())
+            self.idle_tag = None
+            return True
+        tag, command, rest = (line.split(' ', 2) + ['', ''])[:3]
+        command = command.upper()
+        ok = '{} OK {} completed\r\n'.format(tag, command).encode()
+        if command == 'CAPABILITY':
+            self.write('* CAPABILITY IMAP4rev1 IDLE{}\r\n'.format(
+                ' NOTIFY' if self.server.notify else '').encode() + ok)
+        elif command == 'LOGIN':
+            self.user = sync_mail_on_idle.imap_unquote(rest.split(' ')[0])
+            self.write(ok)
+        elif command in ('SELECT', 'EXAMINE'):
+            self.folder = sync_mail_on_idle.imap_unquote(rest)
+            self.write('* {} EXISTS\r\n* 0 RECENT\r\n{} OK [READ-WRITE] SELECT completed\r\n'.format(
+                self.server.count(self.user, self.folder), tag).encode())
+        elif command == 'NOTIFY' and not self.server.notify:
+            self.write('{} BAD NOTIFY not supported\r\n'.format(tag).encode())
+        elif command == 'NOTIFY':
+            mailboxes = re.search(r'\(mailboxes \((.*?)\) \(', rest)
+            self.notify = set(sync_mail_on_idle.imap_unquote(quoted or bare)
+                              for quoted, bare in re.findall(r'("(?:[^"\\]|\\.)*")|(\S+)',
+                                                             mailboxes.group(1)))
+            self.write(ok)
+        elif command == 'IDLE':
+            self.idle_tag = tag
+            self.write(b'+ idling\r\n')
+        elif command == 'LOGOUT':
+            self.write(b'* BYE logging out\r\n' + ok)
+            return False
+        elif command in ('CLOSE', 'NOOP'):
+            self.write(ok)
+        else:
+            self.write('{} BAD unknown command\r\n'.format(tag).encode())
+        return True
+
+    def watches(self, user, folder):
+        return self.idle_tag and self.user == user and (
+            self.folder == folder or folder in self.notify)
+
+
+class fake_imap_server(object):
+    """A scriptable IMAP IDLE/NOTIFY server for the load test."""
+
+    def __init__(self, cert, key, notify=False, messages=10):
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(cert, key)
+        self.notify = notify
+        self.sessions = set()
+        self.messages = {}  # (user, folder) -> message count
+        self.initial = messages  # each folder's message count to start with
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.connected, '127.0.0.1', 0,
+                                                 ssl=self.context, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def connected(self, reader, writer):
+        session = fake_session(self, reader, writer)
+        self.sessions.add(session)
+        await session.run()
+
+    def count(self, user, folder):
+        return self.messages.setdefault((user, folder), self.initial)
+
+    def watched(self):
+        """The number of folders with a session idling on them."""
+        return sum(len(session.notify) if session.notify else 1
+                   for session in self.sessions if session.idle_tag)
+
+    async def wait_watched(self, folders, timeout):
+        """Wait until that many folders are watched, returns the time taken."""
+        start = time.time()
+        while self.watched() < folders:
+            if time.time() - start > timeout:
+                raise TimeoutError('only {} of {} folders are watched'.format(
+                    self.watched(), folders))
+            await asyncio.sleep(0.02)
+        return time.time() - start
+
+    def push(self, user, folder, kind='EXISTS', count=1):
+        """Send count responses of a kind to the sessions watching a folder."""
+        for session in list(self.sessions):
+            if not session.watches(user, folder):
+                continue
+            messages = self.count(user, folder)
+            if session.notify:
+                # NOTIFY only says which folder changed
+                session.write('* STATUS {} (MESSAGES {})\r\n'.format(
+                    sync_mail_on_idle.imap_quote(folder), messages).encode())
+                continue
+            lines = []
+            for i in range(count):
+                if kind == 'EXISTS':
+                    messages += 1
+                    lines.append('* {} EXISTS\r\n'.format(messages))
+                elif kind == 'FETCH':
+                    lines.append('* {} FETCH (FLAGS (\\Seen))\r\n'.format(i % messages + 1))
+                elif kind == 'EXPUNGE' and messages > 1:
+                    lines.append('* {} EXPUNGE\r\n'.format(messages))
+                    messages -= 1
+            self.messages[(user, folder)] = messages
+            session.write(''.join(lines).encode())
+
+    def bye(self):
+        for session in list(self.sessions):
+            session.write(b'* BYE server shutting down\r\n')
+            session.writer.close()
+        self.sessions.clear()
+
+    def drop(self):
+        for session in list(self.sessions):
+            session.writer.transport.abort()
+        self.sessions.clear()
+
+
+def write_config(path, port, cafile, accounts, folders, notify):
+    """Write the watcher's config, returns the [(account, folder)] it watches."""
+    watched = []
+    with open(path, 'w') as f:
+        for a in range(accounts):
+            acct = 'acct{}'.format(a)
+            names = ['INBOX'] + ['Folder {}'.format(i) for i in range(1, folders)]
+            watched.extend((acct, name) for name in names)
+            f.write('[{}]\nuser = {}\npass = secret\nserver = localhost\nport = {}\n'
+                    'cafile = {}\nfolders = {}\ntimeout = 600\nnotify = {}\n\n'.format(
+                        acct, acct, port, cafile, ', '.join(names),
+                        'yes' if notify else 'no'))
+    return watched
+
+
+class stub_log(object):
+    """Reads what the stub offlineimap logged."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def syncs(self):
+        """The new (time, account, folders) since the last call."""
+        try:
+            with open(self.path) as f:
+                f.seek(self.offset)
+                lines = f.readlines()
+                self.offset = f.tell()
+        except FileNotFoundError:
+            return []
+        syncs = []
+        for line in lines:
+            fields = line.split()
+            acct = fields[fields.index('-a') + 1]
+            folders = None
+            if '-f' in fields:
+                folders = line.split(' -f ', 1)[1].rstrip('\n').split(',')
+            syncs.append((float(fields[0]), acct, folders))
+        return syncs
+
+    async def wait_for(self, acct, folder, since, timeout):
+        """Wait for a sync of a folder started after since, returns its time."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for when, synced, folders in self.syncs():
+                if synced == acct and when >= since and (folders is None or folder in folders):
+                    return when
+            await asyncio.sleep(0.005)
+        raise TimeoutError('{} {} was never synced'.format(acct, folder))
+
+
+def process_stats(pid):
+    """(CPU seconds, RSS bytes) of a process, from /proc."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open('/proc/{}/status'.format(pid)) as f:
+        rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+    return cpu, rss
+
+
+def summary(name, values):
+    """One line of latency statistics, in milliseconds."""
+    values = sorted(v * 1000 for v in values)
+    return '{:<24} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+        name, values[0], statistics.median(values),
+        values[math.ceil(len(values) * 0.95) - 1], values[-1])
+
+
+async def load_test(args, directory):
+    cert, key = make_certificate(directory)
+    # Enough messages in each folder for every EXPUNGE burst to hit the same
+    # one, so the sequence numbers stay valid
+    expunge_probes = max(1, args.probes // 10)
+    server = fake_imap_server(cert, key, args.notify,
+                              max(10, args.burst * expunge_probes + 1))
+    port = await server.start()
+
+    log = os.path.join(directory, 'syncs.log')
+    stub = os.path.join(directory, 'offlineimap')
+    with open(stub, 'w') as f:
+        f.write(STUB.format(log=log))
+    os.chmod(stub, 0o755)
+    config = os.path.join(directory, 'idle_mail.ini')
+    watched = write_config(config, port, cert, args.accounts, args.folders, args.notify)
+    syncs = stub_log(log)
+    rng = random.Random(args.seed)
+
+    watcher_log = open(args.watcher_log or os.devnull, 'w')
+    watcher = await asyncio.create_subprocess_exec(
+        sys.executable, sync_mail_on_idle.__file__, '--config', config,
+        '--offlineimap', stub, '--max-syncs', str(args.max_syncs),
+        stdout=watcher_log, stderr=watcher_log)
+    try:
+        startup = await server.wait_watched(len(watched), args.timeout)
+        print('{} folders in {} accounts watched after {:0.2f} s{}'.format(
+            len(watched), args.accounts, startup, ' (NOTIFY)' if args.notify else ''))
+
+        # Idle CPU and memory
+        await asyncio.sleep(1)
+        cpu, _ = process_stats(watcher.pid)
+        await asyncio.sleep(args.idle)
+        cpu_after, rss = process_stats(watcher.pid)
+        print('idle CPU {:0.2f}% over {} s, RSS {:0.1f} MiB ({:0.1f} KiB per folder)'.format(
+            (cpu_after - cpu) / args.idle * 100, args.idle, rss / 2**20,
+            rss / 1024 / len(watched)))
+
+        # Latency of single changes, then of bursts
+        print('{:<24} {:>8} {:>8} {:>8} {:>8}'.format('change to sync (ms)', 'min', 'median', 'p95', 'max'))
+        for kind, count, probes in (('EXISTS', 1, args.probes),
+                                    ('FETCH', args.burst, max(1, args.probes // 10)),
+                                    ('EXPUNGE', args.burst, expunge_probes)):
+            latencies = []
+            for _ in range(probes):
+                acct, folder = rng.choice(watched)
+                syncs.syncs()
+                start = time.time()
+                server.push(acct, folder, kind, count)
+                latencies.append(await syncs.wait_for(acct, folder, start, args.timeout) - start)
+                # Let that sync finish, so the next probe isn't coalesced into it
+                await asyncio.sleep(0.05)
+            print(summary('{} x{}'.format(kind, count), latencies))
+
+        # Recovery after the server goes away
+        for name, action in (('dropped', server.drop), ('BYE', server.bye)):
+            action()
+            await asyncio.sleep(0.1)
+            recovery = await server.wait_watched(len(watched), args.timeout) + 0.1
+            print('recovered from {} connections in {:0.2f} s'.format(name, recovery))
+    finally:
+        watcher.terminate()
+        try:
+            await asyncio.wait_for(watcher.wait(), 15)
+        except asyncio.TimeoutError:
+            watcher.kill()
+        watcher_log.close()
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(
+        description='Load-test sync_mail_on_idle against a fake IMAP server')
+    parser.add_argument('--accounts', '-a', action='store', type=int, default=10,
+                        help='number of accounts (default: %(default)s)')
+    parser.add_argument('--folders', '-f', action='store', type=int, default=30,
+                        help='folders per account (default: %(default)s)')
+    parser.add_argument('--notify', action='store_true',
+                        help='let the server do NOTIFY (one session per account)')
+    parser.add_argument('--max-syncs', action='store', type=int, default=2,
+                        help="the watcher's --max-syncs (default: %(default)s)")
+    parser.add_argument('--probes', '-n', action='store', type=int, default=50,
+                        help='number of single changes to time (default: %(default)s)')
+    parser.add_argument('--burst', action='store', type=int, default=500,
+                        help='responses in each FETCH/EXPUNGE burst (default: %(default)s)')
+    parser.add_argument('--idle', action='store', type=float, default=5,
+                        help='seconds to measure idle CPU over (default: %(default)s)')
+    parser.add_argument('--timeout', action='store', type=float, default=60,
+                        help='give up waiting after this many seconds (default: %(default)s)')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='seed for picking folders (default: %(default)s)')
+    parser.add_argument('--watcher-log', action='store', metavar='FILE',
+                        help="write the watcher's log here")
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s version {}'.format(__version__))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(load_test(args, directory))
+
+
+if __name__ == '__main__':
+    main()